@@ -0,0 +1,138 @@
+"""Memory benchmark for the drawn-element store used during placement.
+
+Builds synthetic render plans of increasing size, groups of rects,
+circles and paths with a few attributes and transforms, and measures the
+peak memory (with tracemalloc) of drawing every element of the plan:
+
+  objects  one object per element holding its svgwrite element, its
+           bounding box object and its transform, in a dict by node, as
+           rendering kept them before elements.ElementTable
+  table    an elements.ElementTable, as rendering keeps them now
+
+and of rendering the whole plan and writing it out as SVG, both through
+an svgwrite Drawing (render.render_plan() and Drawing.write()) and
+streamed (render.write_plan()).  Fails (exit status 1) if the table takes more than the budget
+given with --max-bytes-per-element.
+
+    python benchmarks/memory.py [--sizes 1000,10000,100000] [--max-bytes-per-element B]
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+
+import svgwrite
+
+sys.path.insert( 0, str( Path( __file__ ).resolve().parent.parent ) )
+from svgrammar.elements import ElementTable, shape_box
+from svgrammar.plan import PlanElement, PlanGroup, RenderPlan
+from svgrammar.render import build_layout, render_plan, write_plan
+import svgrammar.transform as transform
+
+def synthetic_plan( num_elements, per_group = 20 ):
+    groups = []
+    count = 0
+    while count < num_elements:
+        elements = []
+        for j in range( min( per_group, num_elements - count ) ):
+            n = "e{}".format( count )
+            count += 1
+            attributes = ( ("fill", "none"), ("stroke", "black") )
+            if j % 3 == 0:
+                elements.append( PlanElement( n, "rect", (j, 0, 10, 5),
+                                              attributes, None ) )
+            elif j % 3 == 1:
+                elements.append( PlanElement(
+                    n, "circle", (0, j, 4),
+                    attributes + ( ("transform", "scale(2)"), ), None ) )
+            else:
+                elements.append( PlanElement(
+                    n, "path", ("M 0 0 C 0 10 {0} 10 {0} 0 Z".format( j ),),
+                    attributes, None ) )
+        group = PlanGroup( "g{}".format( len( groups ) ), tuple( elements ),
+                           tuple( (e.node, ()) for e in elements ), False )
+        groups.append( PlanElement( group.node, "g", (),
+                                    ( ("transform", "rotate(10)"), ), group ) )
+    root = PlanGroup( None, tuple( groups ),
+                      tuple( (e.node, ()) for e in groups ), False )
+    return RenderPlan( (0, 0, 200, 200), root )
+
+class ObjectElement(object):
+    """An element as rendering used to hold it while placing."""
+    def __init__( self, node, svg, bb ):
+        self.svg_element = svg
+        self.bounding_box = bb
+        self.node = node
+        self.matrix = transform.parse_transform(
+            svg.attribs.get( "transform", "" ) )
+
+def draw_objects( drawing, group, drawn ):
+    for element in group.elements:
+        attr = dict( element.attributes )
+        if element.tag == "rect":
+            x, y, width, height = element.geometry
+            svg = drawing.rect( (x, y), (width, height), **attr )
+        elif element.tag == "circle":
+            x, y, radius = element.geometry
+            svg = drawing.circle( (x, y), radius, **attr )
+        elif element.tag == "path":
+            svg = drawing.path( element.geometry[0], **attr )
+        else:
+            svg = drawing.g( **attr )
+            draw_objects( drawing, element.group, drawn )
+        e = ObjectElement( element.node, svg, shape_box( element ) )
+        if element.tag != "g" and e.matrix != transform.identity:
+            e.bounding_box.applyMatrix( e.matrix )
+        drawn[element.node] = e
+
+def draw_table( plan ):
+    table = ElementTable()
+    build_layout( table, None, plan.root )
+    return table
+
+def peak_bytes( f ):
+    """Peak memory allocated while running f."""
+    gc.collect()
+    tracemalloc.start()
+    result = f()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser( description = __doc__.splitlines()[0] )
+    parser.add_argument( "--sizes", default = "1000,10000,100000",
+                         help = "comma-separated plan sizes, in elements" )
+    parser.add_argument( "--max-bytes-per-element", type = float, default = None,
+                         help = "fail if the table takes more than this" )
+    args = parser.parse_args()
+
+    failed = False
+    print( "{:>10} {:>14} {:>14} {:>8} {:>14} {:>14}".format(
+        "elements", "objects B/el", "table B/el", "ratio", "svgwrite B/el",
+        "stream B/el" ) )
+    for size in [ int( s ) for s in args.sizes.split( "," ) ]:
+        plan = synthetic_plan( size )
+        # Count groups as elements too, as both stores hold them
+        num = size + len( plan.root.elements )
+        objects = peak_bytes(
+            lambda: draw_objects( svgwrite.Drawing(), plan.root, {} ) ) / num
+        table = peak_bytes( lambda: draw_table( plan ) ) / num
+        with open( os.devnull, "w" ) as out:
+            svgwrite_output = peak_bytes(
+                lambda: render_plan( plan ).write( out ) ) / num
+            stream = peak_bytes( lambda: write_plan( plan, out ) ) / num
+        over = args.max_bytes_per_element is not None and \
+            table > args.max_bytes_per_element
+        print( "{:10d} {:14.0f} {:14.0f} {:8.1f} {:14.0f} {:14.0f}{}".format(
+            num, objects, table, objects / table, svgwrite_output, stream,
+            "  OVER BUDGET" if over else "" ) )
+        failed = failed or over
+
+    sys.exit( 1 if failed else 0 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark for SVG path parsing and exact path bounds.
+
+Builds random path data with the given numbers of segments, mixing every
+command in absolute and relative form, with the compact number syntax
+("M100-100", ".5.5") and implicit repeated commands, and times parsing it
+with path.parse_path and computing its bounds with path.path_bounds, both
+as drawn and rotated, and with path.PathArrays if numpy is installed.
+Fails (exit status 1) if any size is over the budget given with
+--max-us-per-segment.
+
+    python benchmarks/paths.py [--sizes 1000,10000,100000] [--max-us-per-segment US]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert( 0, str( Path( __file__ ).resolve().parent.parent ) )
+from svgrammar.path import PathArrays, have_numpy, parse_path, path_bounds
+from svgrammar.transform import rotation
+
+def coordinates( rng, count ):
+    # No separator before a negative number, as minifiers write it
+    text = ""
+    for i in range( count ):
+        v = round( rng.uniform( -100, 100 ), 2 )
+        text += str( v ) if v < 0 or i == 0 else " " + str( v )
+    return text
+
+def synthetic_path( num_segments, seed = 0 ):
+    rng = random.Random( seed )
+    parts = [ "M0,0" ]
+    count = 0
+    while count < num_segments:
+        command = rng.choice( "LlHhVvCcSsQqTtAa" )
+        repeats = rng.randint( 1, 3 )
+        if command in "Aa":
+            args = " ".join( "{} {} {} {}{} {}".format(
+                rng.randint( 1, 50 ), rng.randint( 1, 50 ), rng.randint( 0, 90 ),
+                rng.randint( 0, 1 ), rng.randint( 0, 1 ), coordinates( rng, 2 ) )
+                             for i in range( repeats ) )
+        else:
+            arity = { "L" : 2, "H" : 1, "V" : 1, "C" : 6, "S" : 4,
+                      "Q" : 4, "T" : 2 }[command.upper()]
+            args = coordinates( rng, arity * repeats )
+        parts.append( command + args )
+        count += repeats
+    return "".join( parts ), count
+
+def best_time( f, runs ):
+    times = []
+    for i in range( runs ):
+        start = time.perf_counter()
+        f()
+        times.append( time.perf_counter() - start )
+    return min( times )
+
+def main():
+    parser = argparse.ArgumentParser( description = __doc__.splitlines()[0] )
+    parser.add_argument( "--sizes", default = "1000,10000,100000",
+                         help = "comma-separated path sizes, in segments" )
+    parser.add_argument( "--runs", type = int, default = 3 )
+    parser.add_argument( "--max-us-per-segment", type = float, default = None,
+                         help = "fail if parsing and bounds together take "
+                         "longer than this" )
+    args = parser.parse_args()
+
+    failed = False
+    rotated = rotation( 30 )
+    print( "{:>10} {:>12} {:>12} {:>12} {:>12} {:>12}".format(
+        "segments", "parse s", "bounds s", "rotated s", "numpy s", "us/segment" ) )
+    for size in [ int( s ) for s in args.sizes.split( "," ) ]:
+        d, segments = synthetic_path( size )
+        # Parse uncached, to time the parser rather than the cache
+        parse = parse_path.__wrapped__
+        commands = parse( d )
+        parse_time = best_time( lambda: parse( d ), args.runs )
+        bounds_time = best_time( lambda: path_bounds( commands ), args.runs )
+        rotated_time = best_time( lambda: path_bounds( commands, rotated ), args.runs )
+        if have_numpy():
+            # Building the arrays and the bounds, as PathBoundingBox does
+            array_time = "{:12.4f}".format( best_time(
+                lambda: PathArrays( commands ).bounds(), args.runs ) )
+        else:
+            array_time = "{:>12}".format( "-" )
+        per_segment = ( parse_time + bounds_time ) / segments * 1e6
+        over = args.max_us_per_segment is not None and \
+            per_segment > args.max_us_per_segment
+        print( "{:10d} {:12.4f} {:12.4f} {:12.4f} {} {:12.2f}{}".format(
+            segments, parse_time, bounds_time, rotated_time, array_time,
+            per_segment, "  OVER BUDGET" if over else "" ) )
+        failed = failed or over
+
+    sys.exit( 1 if failed else 0 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Startup-time benchmark for the svgrammar CLI modules.
+
+Imports each module in a fresh interpreter several times and reports the
+median wall-clock time.  Fails (exit status 1) if any of the heavy,
+debugging-only modules get imported, or if the median is over the
+budget given with --max-ms.
+
+    python benchmarks/startup.py [--runs N] [--max-ms MS]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+root = Path( __file__ ).resolve().parent.parent
+
+# Modules that rendering must not need
+forbidden = [ "matplotlib", "soffit.display", "pygraphviz" ]
+
+probe = """
+import sys
+import {module}
+bad = [ m for m in {forbidden!r} if m in sys.modules ]
+if bad:
+    print( "imported", ", ".join( bad ) )
+    sys.exit( 2 )
+"""
+
+def time_import( module, runs ):
+    times = []
+    for i in range( runs ):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [ sys.executable, "-c",
+              probe.format( module = module, forbidden = forbidden ) ],
+            cwd = root, capture_output = True, text = True )
+        times.append( ( time.perf_counter() - start ) * 1000.0 )
+        if result.returncode != 0:
+            return None, result.stdout.strip() or result.stderr.strip().splitlines()[-1]
+    return statistics.median( times ), None
+
+def main():
+    parser = argparse.ArgumentParser( description = __doc__.splitlines()[0] )
+    parser.add_argument( "--runs", type = int, default = 5 )
+    parser.add_argument( "--max-ms", type = float, default = None,
+                         help = "fail if any median import time exceeds this" )
+    args = parser.parse_args()
+
+    baseline, error = time_import( "sys", args.runs )
+    print( "{:24} {:8.1f} ms".format( "(interpreter)", baseline ) )
+
+    failed = False
+    for module in [ "svgrammar.render", "svgrammar.grammar" ]:
+        ms, error = time_import( module, args.runs )
+        if ms is None:
+            if "No module named 'soffit'" in error:
+                print( "{:24} skipped, soffit is not installed".format( module ) )
+                continue
+            print( "{:24} FAILED: {}".format( module, error ) )
+            failed = True
+            continue
+        over = args.max_ms is not None and ms > args.max_ms
+        print( "{:24} {:8.1f} ms{}".format( module, ms,
+                                            "  OVER BUDGET" if over else "" ) )
+        failed = failed or over
+
+    sys.exit( 1 if failed else 0 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Scaling benchmark for render.top_level_elements.
+
+Builds synthetic expanded graphs of increasing size, each an svg root
+holding groups nested a few levels deep, with rects inside the groups and
+at the top level, "below" ordering edges and attribute nodes, and times
+finding the top-level elements.  Linear scaling shows up as a roughly
+constant time per node.  Fails (exit status 1) if any size is over the
+budget given with --max-us-per-node.
+
+    python benchmarks/top_level.py [--sizes 1000,10000,100000] [--max-us-per-node US]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+import networkx as nx
+
+sys.path.insert( 0, str( Path( __file__ ).resolve().parent.parent ) )
+from svgrammar.render import top_level_elements
+
+def synthetic_graph( num_nodes, seed = 0 ):
+    rng = random.Random( seed )
+    g = nx.DiGraph()
+    g.add_node( "svg", tag = "svg" )
+    groups = []
+    count = 0
+    while len( g ) < num_nodes:
+        n = "n{}".format( count )
+        count += 1
+        if len( groups ) == 0 or rng.random() < 0.1:
+            g.add_node( n, tag = "g" )
+            parent = rng.choice( groups ) if groups and rng.random() < 0.7 else None
+            groups.append( n )
+        else:
+            g.add_node( n, tag = "rect" )
+            parent = rng.choice( groups ) if rng.random() < 0.9 else None
+            # An attribute, like the grammar would attach
+            g.add_node( n + "w", tag = "10" )
+            g.add_edge( n, n + "w", tag = "width" )
+        if parent is not None:
+            g.add_edge( parent, n )
+        if count > 1 and rng.random() < 0.2:
+            g.add_edge( n, "n{}".format( rng.randrange( count - 1 ) ),
+                        tag = "below" )
+    return g
+
+def main():
+    parser = argparse.ArgumentParser( description = __doc__.splitlines()[0] )
+    parser.add_argument( "--sizes", default = "1000,10000,100000",
+                         help = "comma-separated graph sizes, in nodes" )
+    parser.add_argument( "--runs", type = int, default = 3 )
+    parser.add_argument( "--max-us-per-node", type = float, default = None,
+                         help = "fail if any size takes longer than this" )
+    args = parser.parse_args()
+
+    failed = False
+    print( "{:>10} {:>10} {:>12} {:>12}".format(
+        "nodes", "top-level", "seconds", "us/node" ) )
+    for size in [ int( s ) for s in args.sizes.split( "," ) ]:
+        g = synthetic_graph( size )
+        times = []
+        for i in range( args.runs ):
+            start = time.perf_counter()
+            svg, elems = top_level_elements( g )
+            elems = list( elems )
+            times.append( time.perf_counter() - start )
+        best = min( times )
+        per_node = best / len( g ) * 1e6
+        over = args.max_us_per_node is not None and per_node > args.max_us_per_node
+        print( "{:10d} {:10d} {:12.4f} {:12.2f}{}".format(
+            len( g ), len( elems ), best, per_node,
+            "  OVER BUDGET" if over else "" ) )
+        failed = failed or over
+
+    sys.exit( 1 if failed else 0 )
+
+if __name__ == "__main__":
+    main()
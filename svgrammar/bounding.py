@@ -1,65 +1,34 @@
 """Bounding box data structure and calculations."""
-import re
+from .path import PathArrays, have_numpy, parse_path, path_bounds
+from .transform import identity, multiply, translation, transform_box, \
+    transform_ellipse
 
-translate_re = re.compile( "translate\(\s*(-?\d+(\.\d+)?)(\s+|\s*,\s*)(-?\d+(\.\d+)?)\s*\)" )
-scale_re = re.compile( "scale\(\s*(-?\d+(\.\d+)?)(\s+|\s*,\s*)(-?\d+(\.\d+)?)\s*\)" )
+# Paths with at least this many commands get their bounds from numpy
+# arrays, if numpy is installed; for shorter ones, building the arrays
+# costs more than it saves.
+array_path_commands = 512
 
-def parse_transforms( s ):
-    txs = []
-
-    while len( s ) > 0:
-        m = translate_re.match( s )
-        if m is not None:
-            txs.append( ( "translate", float( m.group(1) ), float( m.group(4) ) ) )
-            s = s[len(m.group(0)):].lstrip()
-            continue
-
-        m = scale_re.match( s )
-        if m is not None:
-            txs.append( ( "scale", float( m.group(1) ), float( m.group(4) ) ) )
-            s = s[len(m.group(0)):].lstrip()
-            continue
-
-        print( "Warning: unmatched transform '{}'".format( transform ) )
-        break
-
-    return txs
-    
-    
 class BoundingBox(object):
+    __slots__ = ( "x1", "y1", "x2", "y2" )
+
     def __init__( self ):
         self.x1 = None
         self.y1 = None
         self.x2 = None
         self.y2 = None
 
-
-    def applyTransform( self, transform ):
-        # TODO: handle rotate
-
-        # Apply in reverse order
-        for t in reversed( parse_transforms( transform ) ):
-            if t[0] == "translate":
-                _, dx, dy = t
-                #print( "Translating by", dx, dy )
-                self.x1 += dx
-                self.x2 += dx
-                self.y1 += dy
-                self.y2 += dy
-            elif t[0] == "scale":
-                _, sx, sy = t
-                self.x1 *= sx
-                self.x2 *= sx
-                if self.x2 < self.x1:
-                    self.x1, self.x2 = self.x2, self.x1
-                self.y1 *= sy
-                self.y2 *= sy
-                if self.y2 < self.y1:
-                    self.y1, self.y2 = self.y2, self.y1
-            else:
-                print( "Warning: unhandled transform '{}'".format( t ) )
+    def applyMatrix( self, m ):
+        """Replace the box by the bounds of its transformed corners.  This
+        is exact for a rectangle; for other shapes under rotation or skew
+        it can be larger than the shape's own bounds."""
+        if self.x1 is None:
+            return
+        self.x1, self.y1, self.x2, self.y2 = \
+            transform_box( m, self.x1, self.y1, self.x2, self.y2 )
 
     def translate( self, dx, dy ):
+        if self.x1 is None:
+            return
         self.x1 += dx
         self.x2 += dx
         self.y1 += dy
@@ -69,6 +38,8 @@ class BoundingBox(object):
         return "({},{})--({},{})".format( self.x1, self.y1, self.x2, self.y2 )
 
 class RectangleBoundingBox(BoundingBox):
+    __slots__ = ()
+
     def __init__( self, x, y, width, height ):
         super().__init__()
         self.x1 = x
@@ -77,6 +48,8 @@ class RectangleBoundingBox(BoundingBox):
         self.y2 = y + height
 
 class CircleBoundingBox(BoundingBox):
+    __slots__ = ()
+
     def __init__( self, x, y, radius ):
         super().__init__()
         self.x1 = x - radius
@@ -84,131 +57,48 @@ class CircleBoundingBox(BoundingBox):
         self.x2 = x + radius
         self.y2 = y + radius
 
-def none_min( a, b ):
-    if a is None:
-        return b
-    if b is None:
-        return a
-    if a < b:
-        return a
-    else:
-        return b
-
-def none_max( a, b ):
-    if a is None:
-        return b
-    if b is None:
-        return a
-    if a > b:
-        return a
-    else:
-        return b
+    def applyMatrix( self, m ):
+        # The box is that of an axis-aligned ellipse (a circle, unless
+        # already scaled), whose transformed bounds are known exactly.
+        if self.x1 is None:
+            return
+        self.x1, self.y1, self.x2, self.y2 = transform_ellipse(
+            m, ( self.x1 + self.x2 ) / 2, ( self.y1 + self.y2 ) / 2,
+            ( self.x2 - self.x1 ) / 2, ( self.y2 - self.y1 ) / 2 )
 
 class GroupBoundingBox(BoundingBox):
-    def __init__( self ):
-        super().__init__()
-        
-    def addElement( self, bb ):
-        self.x1 = none_min( self.x1, bb.x1 )
-        self.y1 = none_min( self.y1, bb.y1 )
-        self.x2 = none_max( self.x2, bb.x2 )
-        self.y2 = none_max( self.y2, bb.y2 )
-
-# TODO: use a real parser and handle junk like M100-100 which is technically
-# legal.
-# TODO: also handle commas
-# TODO: and implicit lines/curves
-# TODO: and actually calculate bezier extrema?
-# TODO: "S" and "T"
-def simulate_path( d ):
-    path = iter( d.split() )
-    x = None
-    y = None
-    firstPoint = None
-    
-    while True:
-        try:
-            kw = next( path )
-        except StopIteration:
-            return
-        
-        if kw == "M" or kw == "L":
-            x = float( next( path ) )
-            y = float( next( path ) )
-            if firstPoint is None:
-                firstPoint = (x,y)
-            yield (x,y)
-        elif kw == "m" or kw == "l":
-            x += float( next( path ) )
-            y += float( next( path ) )
-            yield (x,y)
-        elif kw == "H":
-            x = float( next( path ) )
-            yield (x,y)
-        elif kw == "V":
-            y = float( next( path ) )
-            yield (x,y)
-        elif kw == "h":
-            x += float( next( path ) )
-            yield (x,y)
-        elif kw == "v":
-            y += float( next( path ) )
-            yield (x,y)
-        elif kw == "Z" or kw == "z":
-            x,y = firstPoint
-        elif kw == "C":
-            cx1, cy1 = float( next(path) ), float( next(path) )
-            cx2, cy2 = float( next(path) ), float( next(path) )
-            x = float( next(path) )
-            y = float( next(path) )
-            yield (x,y)
-        elif kw == "c":
-            cx1, cy1 = x + float( next(path) ), y + float( next(path) )
-            cx2, cy2 = x + float( next(path) ), y + float( next(path) )
-            x += float( next(path) )
-            y += float( next(path) )
-            yield (x,y)
-        elif kw == "Q":
-            cx1, cy1 = float( next(path) ), float( next(path) )
-            x = float( next(path) )
-            y = float( next(path) )
-            yield (x,y)
-        elif kw == "q":
-            cx1, cy1 = x + float( next(path) ), y + float( next(path) )
-            x += float( next(path) )
-            y += float( next(path) )
-            yield (x,y)
-        elif kw == "A":
-            # A rx ry x-axis-rotation large-arc-flag sweep-flag x y
-            # a rx ry x-axis-rotation large-arc-flag sweep-flag dx dy
-            rx, ry = float( next(path) ), float( next(path) )
-            rot = float( next(path) )
-            laf, sw = float( next(path) ), float( next(path) )
-            x = float( next(path) )
-            y = float( next(path) )
-            yield (x,y)
-        elif kw == "a":
-            rx, ry = float( next(path) ), float( next(path) )
-            rot = float( next(path) )
-            laf, sw = float( next(path) ), float( next(path) )
-            x += float( next(path) )
-            y += float( next(path) )
-            yield (x,y)
-        else:
-            raise Exception( "Unhandled SVG path command '{}'".format( kw ) )
-    
+    """An empty box; a group's box is merged from its members' once they
+    are placed, see elements.ElementTable.merge()."""
+    __slots__ = ()
+
 class PathBoundingBox(BoundingBox):
+    """The exact bounds of a path, curves and arcs included.  The parsed
+    commands are kept, so that under a transform the bounds are those of
+    the transformed path rather than of the transformed box."""
+    __slots__ = ( "commands", "arrays", "matrix" )
+
     def __init__( self, d ):
         super().__init__()
-        for x,y in simulate_path( d ):
-            #print( "Path visited", (x,y) )
-            self.x1 = none_min( self.x1, x )
-            self.y1 = none_min( self.y1, y )
-            self.x2 = none_max( self.x2, x )
-            self.y2 = none_max( self.y2, y )
-            
-
-            
-    
-        
-                
+        self.commands = parse_path( d )
+        if len( self.commands ) >= array_path_commands and have_numpy():
+            self.arrays = PathArrays( self.commands )
+        else:
+            self.arrays = None
+        self.matrix = identity
+        self.update()
+
+    def update( self ):
+        if self.arrays is not None:
+            bounds = self.arrays.bounds( self.matrix )
+        else:
+            bounds = path_bounds( self.commands, self.matrix )
+        if bounds is not None:
+            self.x1, self.y1, self.x2, self.y2 = bounds
+
+    def applyMatrix( self, m ):
+        self.matrix = multiply( m, self.matrix )
+        self.update()
+
+    def translate( self, dx, dy ):
+        super().translate( dx, dy )
+        self.matrix = multiply( translation( dx, dy ), self.matrix )
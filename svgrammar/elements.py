@@ -0,0 +1,110 @@
+"""Compact storage for the elements of a drawing while they are placed.
+
+Rendering numbers every element it draws from a RenderPlan, in drawing
+order, and keeps their bounding boxes and transforms in flat float64
+arrays indexed by that number, rather than in an object per element.
+The SVG elements themselves are only created once placement is done,
+from the plan and the final transforms; see render.render_plan()."""
+from array import array
+import math
+import svgrammar.bounding as bounding
+import svgrammar.transform as transform
+from .placement import Box
+
+def shape_box( element ):
+    """The bounding box of a plan element as drawn, before its transform."""
+    if element.tag == "rect":
+        return bounding.RectangleBoundingBox( *element.geometry )
+    elif element.tag == "circle":
+        return bounding.CircleBoundingBox( *element.geometry )
+    elif element.tag == "path":
+        return bounding.PathBoundingBox( *element.geometry )
+    else:
+        return bounding.GroupBoundingBox()
+
+class ElementTable(object):
+    """The drawn elements of a plan.  Element i has the PlanElement
+    elements[i], the box boxes[4*i:4*i+4] as (x1, y1, x2, y2), NaN while
+    empty, and the transform matrices[6*i:6*i+6].  moved[i] is set once
+    the element has been translated, and its transform attribute must be
+    written from the matrix.  members[i] lists the ids of the members of
+    group i, in order, with the top level's under None.  A node drawn more
+    than once, because several groups include it or through "!"
+    references, has a separate element for each copy."""
+    def __init__( self ):
+        self.elements = []
+        self.members = {}
+        self.boxes = array( "d" )
+        self.matrices = array( "d" )
+        self.moved = bytearray()
+
+    def __len__( self ):
+        return len( self.elements )
+
+    def add( self, element ):
+        """Draw a plan element: record its transform and its box under
+        that transform.  A group's box stays empty until merge()."""
+        i = len( self.elements )
+        m = transform.parse_transform(
+            dict( element.attributes ).get( "transform", "" ) )
+        bb = shape_box( element )
+        if element.tag != "g" and m != transform.identity:
+            bb.applyMatrix( m )
+        self.elements.append( element )
+        self.matrices.extend( m )
+        if bb.x1 is None:
+            self.boxes.extend( ( math.nan, ) * 4 )
+        else:
+            self.boxes.extend( ( bb.x1, bb.y1, bb.x2, bb.y2 ) )
+        self.moved.append( 0 )
+        return i
+
+    def box( self, i ):
+        """Element i's box as a placement.Box, with None for an empty one."""
+        x1, y1, x2, y2 = self.boxes[4*i:4*i+4]
+        if math.isnan( x1 ):
+            return Box( None, None, None, None )
+        return Box( x1, y1, x2, y2 )
+
+    def __getitem__( self, i ):
+        # The box of element i, as read by Solver
+        return self.box( i )
+
+    def matrix( self, i ):
+        return tuple( self.matrices[6*i:6*i+6] )
+
+    def translate( self, i, dx, dy ):
+        # Composed on the left, so that it is performed last, which only
+        # changes the translation part of the matrix.
+        self.matrices[6*i+4] += dx
+        self.matrices[6*i+5] += dy
+        self.moved[i] = 1
+        if not math.isnan( self.boxes[4*i] ):
+            self.boxes[4*i] += dx
+            self.boxes[4*i+1] += dy
+            self.boxes[4*i+2] += dx
+            self.boxes[4*i+3] += dy
+
+    def merge( self, i, members ):
+        """Set group i's box to the bounds of its placed members' boxes,
+        under the group's transform."""
+        boxes = self.boxes
+        corners = [ boxes[4*j:4*j+4] for j in members
+                    if not math.isnan( boxes[4*j] ) ]
+        if len( corners ) == 0:
+            return
+        x1 = min( [ c[0] for c in corners ] )
+        y1 = min( [ c[1] for c in corners ] )
+        x2 = max( [ c[2] for c in corners ] )
+        y2 = max( [ c[3] for c in corners ] )
+        m = self.matrix( i )
+        if m != transform.identity:
+            x1, y1, x2, y2 = transform.transform_box( m, x1, y1, x2, y2 )
+        boxes[4*i:4*i+4] = array( "d", ( x1, y1, x2, y2 ) )
+
+    def transform_attribute( self, i ):
+        """Element i's transform attribute, as placed, or None to keep the
+        one it was drawn with."""
+        if self.moved[i]:
+            return transform.to_string( self.matrix( i ) )
+        return None
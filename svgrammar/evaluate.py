@@ -7,42 +7,117 @@ placement_relations = set( ["adjacent-left", "adjacent-right",
                             "place-above", "place-below",
                             "disjoint" ])
 
+class EdgeIndex(object):
+    """The out-edges of every node, read from the graph once.  For each
+    node, 'out' has its (tag, target) pairs in the graph's edge order,
+    and the other tables have just the targets of the untagged, "next"
+    and "below" edges, and the (tag, target) pairs of the placement
+    relations.  Nodes without such edges are left out."""
+    def __init__( self, graph ):
+        self.rebuild( graph )
+
+    def rebuild( self, graph ):
+        self.out = {}
+        self.untagged = {}
+        self.next = {}
+        self.below = {}
+        self.placement = {}
+        for i, j, t in graph.edges( data="tag" ):
+            self.add( i, j, t )
+
+    def add( self, i, j, t ):
+        self.out.setdefault( i, [] ).append( (t, j) )
+        if t is None:
+            self.untagged.setdefault( i, [] ).append( j )
+        elif t == "next":
+            self.next.setdefault( i, [] ).append( j )
+        elif t == "below":
+            self.below.setdefault( i, [] ).append( j )
+        elif t in placement_relations:
+            self.placement.setdefault( i, [] ).append( (t, j) )
+
+    def update( self, graph, n ):
+        """Read the out-edges of n from the graph again."""
+        for table in ( self.out, self.untagged, self.next, self.below,
+                       self.placement ):
+            table.pop( n, None )
+        if n in graph:
+            for i, j, t in graph.out_edges( n, data="tag" ):
+                self.add( i, j, t )
+
+    def children( self, n, in_list = False ):
+        """(tag, target) pairs of n, leaving out "next" edges in a list."""
+        if in_list and n in self.next:
+            return [ (t, j) for t, j in self.out[n] if t != "next" ]
+        return self.out.get( n, [] )
+
+    def next_targets( self, n ):
+        """Targets of the "next" edges of n."""
+        return self.next.get( n, [] )
+
+class LazyEdgeIndex(EdgeIndex):
+    """An EdgeIndex that reads the out-edges of a node from the graph the
+    first time they are looked up, for evaluating a few nodes of a
+    large graph, where indexing every edge would cost more than it
+    saves."""
+    def rebuild( self, graph ):
+        self.graph = graph
+        self.read = set()
+        self.out = {}
+        self.untagged = {}
+        self.next = {}
+        self.below = {}
+        self.placement = {}
+
+    def update( self, graph, n ):
+        self.read.add( n )
+        EdgeIndex.update( self, graph, n )
+
+    def children( self, n, in_list = False ):
+        if n not in self.read:
+            self.update( self.graph, n )
+        return EdgeIndex.children( self, n, in_list )
+
+    def next_targets( self, n ):
+        if n not in self.read:
+            self.update( self.graph, n )
+        return EdgeIndex.next_targets( self, n )
+
+# Returned by Evaluation.enter() for a node it has pushed on the stack;
+# any other value, even None, is a node's value.
+pushed = object()
+
 class Evaluation(object):
-    def __init__( self, graph, in_list = False ):
+    def __init__( self, graph, in_list = False, index = None ):
         self.graph = graph
+        self.index = index if index is not None else LazyEdgeIndex( graph )
         self.in_list = in_list
+        # Values of function nodes, by node.  Values depend on whether we
+        # are in a list, so each Evaluation has its own.
+        self.values = {}
         self.funcs = {
-            "!" : self.bang_value,
-            "+" : self.plus_value,
-            "rgb" : self.rgb_value,
-            "##" : self.concat_value,
-            "translate" : self.translate_value,
-            "scale" : self.translate_value,
-            "skewX" : self.angle_value,
-            "skewY" : self.angle_value,
-            "rotate" : self.angle_value,            
+            "!" : (self.bang_inputs, self.bang_value),
+            "+" : (self.plus_inputs, self.plus_value),
+            "rgb" : (self.rgb_inputs, self.rgb_value),
+            "##" : (self.concat_inputs, self.concat_value),
+            "translate" : (self.translate_inputs, self.translate_value),
+            "scale" : (self.translate_inputs, self.translate_value),
+            "skewX" : (self.angle_inputs, self.angle_value),
+            "skewY" : (self.angle_inputs, self.angle_value),
+            "rotate" : (self.angle_inputs, self.angle_value),
             }
     
 
     def successors( self, n ):
-        if self.in_list:
-            return [ j for i,j,tag in self.graph.out_edges( n, data="tag" )
-                     if tag != "next" ]
-        else:
-            return self.graph.successors( n )
+        return [ j for tag,j in self.children( n ) ]
 
     def list_successors( self, n ):
         assert self.in_list
         
-        return [ j for i,j,tag in self.graph.out_edges( n, data="tag" )
-                 if tag == "next" ]
+        return self.index.next_targets( n )
         
     def children( self, n ):
-        if self.in_list:
-            return [ (tag,j) for i,j,tag in self.graph.out_edges( n, data="tag" )
-                     if tag != "next" ]
-        else:
-            return [ (tag,j) for i,j,tag in self.graph.out_edges( n, data="tag" ) ]
+        return self.index.children( n, self.in_list )
                 
         
     def sorted_successors( self, n ):
@@ -72,36 +147,25 @@ class Evaluation(object):
             
         return kv
 
-    def successor_value_dictionary_with_lists( self, n, list_attrs ):
-        # Interpret edges with tags in list_attrs as the start of a list
-        # rather than a string value.
-        kv = {}
-        for tag, j in self.children( n ):
-            if tag is None:
-                continue
-            if tag in placement_relations:
-                continue
-            if tag in kv:
-                raise Exception( "Duplicate keyword {} in node {}".format( tag, n ) )
-            if tag in list_attrs:
-                e_list = Evaluation( self.graph, in_list = True )
-                kv[tag] = e_list.list_value( j, [n] )
-            else:
-                kv[tag] = self.node_value( j, [n] )
-                
-            
-        return kv
-
-    def bang_value( self, n, visited ):
+    # Each function tag has an inputs method, returning (key, node) pairs
+    # for the nodes it needs the values of, and a value method, which
+    # combines those values given as a dictionary by key.
+    
+    def bang_inputs( self, n ):
         successors = list( self.successors( n ) )
         if len( successors ) > 1:
             raise Exception( "Too many children in '!' node '" + str( n ) + "'" )
-        return self.node_value( successors[0], visited )
+        return [ (0, successors[0]) ]
 
-    def plus_value( self, n, visited ):
+    def bang_value( self, n, values ):
+        return values[0]
+
+    def plus_inputs( self, n ):
+        return list( enumerate( self.successors( n ) ) )
+    
+    def plus_value( self, n, values ):
         total = 0.0
-        for nn in self.successors( n ):
-            text = self.node_value( nn, visited )
+        for text in values.values():
             try:
                 total += float( text )
             except ValueError:
@@ -109,89 +173,200 @@ class Evaluation(object):
                 continue
         return str( total )
 
-    def concat_value( self, n, visited ):
-        vals = [ self.node_value( j, visited )
-                 for j in self.sorted_successors( n ) ]
-        return " ".join( vals )
+    def concat_inputs( self, n ):
+        return list( enumerate( self.sorted_successors( n ) ) )
+    
+    def concat_value( self, n, values ):
+        return " ".join( values.values() )
 
-    def float_or_zero( self, children, key, visited ):
-        if key not in children:
+    def float_or_zero( self, values, key ):
+        if key not in values:
             return 0
         
         try:
-            return float( self.node_value( children[key], visited ) )
+            return float( values[key] )
         except ValueError:
             return 0
                 
-    def int_or_zero( self, children, key, visited ):
-        if key not in children:
+    def int_or_zero( self, values, key ):
+        if key not in values:
             return 0
         
         try:
-            return int( self.node_value( children[key], visited ) )
+            return int( values[key] )
         except ValueError:
             return 0
-                
-    def rgb_value( self, n, visited ):
+
+    def keyed_inputs( self, n, keys ):
         d = self.successor_dictionary( n )
-        red = min( self.int_or_zero( d, "r", visited ), 255 )
-        green = min( self.int_or_zero( d, "g", visited ), 255 )
-        blue = min( self.int_or_zero( d, "b", visited ), 255 )
+        return [ (k, d[k]) for k in keys if k in d ]
+        
+    def rgb_inputs( self, n ):
+        return self.keyed_inputs( n, [ "r", "g", "b" ] )
+    
+    def rgb_value( self, n, values ):
+        red = min( self.int_or_zero( values, "r" ), 255 )
+        green = min( self.int_or_zero( values, "g" ), 255 )
+        blue = min( self.int_or_zero( values, "b" ), 255 )
         return "rgb({},{},{})".format( red, green, blue )        
 
-    def translate_value( self, n, visited ):
-        d = self.successor_dictionary( n )
-        x = self.float_or_zero( d, "x", visited )
-        y = self.float_or_zero( d, "y", visited )
-        return "{}({},{})".format( self.graph.nodes[n]["tag"], x,y )
+    def translate_inputs( self, n ):
+        return self.keyed_inputs( n, [ "x", "y" ] )
     
-    def angle_value( self, n, visited ):
+    def translate_value( self, n, values ):
+        x = self.float_or_zero( values, "x" )
+        y = self.float_or_zero( values, "y" )
+        return "{}({},{})".format( self.graph.nodes[n]["tag"], x,y )
+
+    def angle_inputs( self, n ):
         # FIXME: does SVG allow a non-numeric value here, like a
         # definition?
         children = self.successor_dictionary( n )
         if "d" in children:
-            d = self.float_or_zero( children, "d", visited )
+            return [ ("d", children["d"]) ]
         elif len( children ) > 0:
             k = list( children.keys() )[0]
-            d = self.float_or_zero( children, k, visited )
+            return [ ("d", children[k]) ]
         else:
-            d = 0
-            
+            return []
+    
+    def angle_value( self, n, values ):
+        d = self.float_or_zero( values, "d" )
         return "{}({})".format( self.graph.nodes[n]["tag"], d )
 
     def node_value( self, n, visited ):
+        """Evaluate node n.  'visited' lists the nodes already being
+        evaluated, which n must not depend on."""
+        return self.evaluate( n, set( visited ) )
+
+    def enter( self, n, in_progress, stack ):
+        """Start evaluating n: return its value if it is already known,
+        or else push it on the stack and return pushed."""
         # OK to visit the same node more than once, just not as a child
         # of itself.
-        if n in visited:
+        if n in in_progress:
             raise Exception( "Circular evaluation at node '" + str( n ) + "'" )
 
         if "tag" not in self.graph.nodes[n]:
             return ""
 
         # Cached value
-        if "value" in self.graph.nodes[n]:
-            return self.graph.nodes[n]["value"]
+        if n in self.values:
+            return self.values[n]
 
         tag = self.graph.nodes[n]["tag"]
-        if tag in self.funcs:
-                val = self.funcs[tag]( n, visited + [n] )
-                self.graph.nodes[n]["value"] = val
-                return val
-        else:
-                return tag
+        if tag not in self.funcs:
+            return tag
+        inputs, combine = self.funcs[tag]
+        stack.append( (n, combine, inputs( n ), {}) )
+        in_progress.add( n )
+        return pushed
+    
+    def evaluate( self, n, in_progress ):
+        """Evaluate n with an explicit stack instead of recursion, so that
+        deep expressions do not hit the recursion limit.  in_progress is
+        the set of nodes being evaluated; it is restored on return."""
+        stack = []
+        val = self.enter( n, in_progress, stack )
+        while len( stack ) > 0:
+            m, combine, inputs, values = stack[-1]
+            if len( values ) < len( inputs ):
+                key, j = inputs[len( values )]
+                val = self.enter( j, in_progress, stack )
+                if val is not pushed:
+                    values[key] = val
+                continue
+
+            stack.pop()
+            in_progress.discard( m )
+            val = combine( m, values )
+            self.values[m] = val
+            if len( stack ) > 0:
+                m, combine, inputs, values = stack[-1]
+                values[inputs[len( values )][0]] = val
+        return val
         
     def list_value( self, n, visited ):
+        """Evaluate the list starting at n, following "next" edges depth
+        first.  Each element must not depend on the ones before it."""
         assert self.in_list
-        
-        v = self.node_value( n, visited )
-        list_next = self.list_successors( n )
-        ret = [v]
-        for ln in list_next:
-            ret += self.list_value( ln, visited + [n] )
+
+        ret = []
+        in_progress = set( visited )
+        # Entries are (node, False) to evaluate a node and (node, True) to
+        # backtrack past it.
+        stack = [ (n, False) ]
+        while len( stack ) > 0:
+            m, leaving = stack.pop()
+            if leaving:
+                in_progress.discard( m )
+                continue
+            ret.append( self.evaluate( m, in_progress ) )
+            in_progress.add( m )
+            stack.append( (m, True) )
+            for ln in reversed( self.list_successors( m ) ):
+                stack.append( (ln, False) )
         return ret
         
+class EvaluationContext(object):
+    """Evaluates the attributes of elements, sharing cached values across
+    all the elements of a render.  The cache is kept here rather than in
+    the graph, so the graph is not modified; if it does change, call
+    invalidate().  The out-edges of the graph are indexed once, up front,
+    unless another index is given."""
+    def __init__( self, graph, index = None ):
+        self.graph = graph
+        self.index = index if index is not None else EdgeIndex( graph )
+        self.evaluation = Evaluation( graph, index = self.index )
+        self.list_evaluation = Evaluation( graph, in_list = True,
+                                           index = self.index )
+
+    def attributes( self, n, list_attrs = [] ):
+        """Return the attributes of n as a dictionary.  Edges with tags in
+        list_attrs are the start of a list rather than a single value."""
+        kv = {}
+        for tag, j in self.evaluation.children( n ):
+            if tag is None:
+                continue
+            if tag in placement_relations:
+                continue
+            if tag in kv:
+                raise Exception( "Duplicate keyword {} in node {}".format( tag, n ) )
+            if tag in list_attrs:
+                kv[tag] = self.list_evaluation.list_value( j, [n] )
+            else:
+                kv[tag] = self.evaluation.node_value( j, [n] )
+        return kv
+
+    def invalidate( self, nodes = None ):
+        """Forget cached values: all of them, or those of the given nodes
+        and of every node that can reach them, as a value only depends on
+        the node's successors.  After changing an edge (i, j), pass i."""
+        caches = [ self.evaluation.values, self.list_evaluation.values ]
+        if nodes is None:
+            self.index.rebuild( self.graph )
+            for c in caches:
+                c.clear()
+            return
+
+        for n in nodes:
+            self.index.update( self.graph, n )
+        pending = list( nodes )
+        seen = set( pending )
+        while len( pending ) > 0:
+            n = pending.pop()
+            for c in caches:
+                c.pop( n, None )
+            if n in self.graph:
+                for p in self.graph.predecessors( n ):
+                    if p not in seen:
+                        seen.add( p )
+                        pending.append( p )
+        
 def extract_all_attributes( g, n, list_attrs = [] ):
-    ev = Evaluation( g, in_list = False )
-    return ev.successor_value_dictionary_with_lists( n, list_attrs )
+    """The attributes of a single node n.  Only the nodes its value
+    depends on are read; to evaluate many nodes, share an
+    EvaluationContext."""
+    return EvaluationContext( g, LazyEdgeIndex( g ) ).attributes( n, list_attrs )
 
 
@@ -1,26 +1,277 @@
 import soffit.application as soffit
-import soffit.display as display
 import svgrammar.render as render
+from svgrammar.placement import solver_class
+from svgrammar.plan import load_plan, save_plan
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
 import sys
+import time
 from pathlib import Path
 
+# Grammars already loaded by this process, by file name.
+grammar_cache = {}
+
+def load_grammar( grammarFile ):
+    if grammarFile not in grammar_cache:
+        grammar_cache[grammarFile] = soffit.loadGrammar( grammarFile )
+    return grammar_cache[grammarFile]
+
+def stage_seeds( seed ):
+    """Derive separate seeds for grammar expansion and for placement from
+    one seed, so that a change in how much randomness one stage uses does
+    not change the other."""
+    stages = random.Random( seed )
+    return stages.getrandbits( 64 ), stages.getrandbits( 64 )
+
+def expand( grammar, iterations = 1000, seed = None ):
+    """Run the grammar on its start graph.  soffit draws from the random
+    module, so with a seed the module is seeded for the expansion and
+    its previous state restored afterwards."""
+    if seed is not None:
+        saved = random.getstate()
+        random.seed( seed )
+    try:
+        a = soffit.ApplicationState( grammar = grammar,
+                                     initialGraph = grammar.start )
+        a.run( iterations )
+    finally:
+        if seed is not None:
+            random.setstate( saved )
+    return a.graph
+
+def compile_grammar( grammar, seed = None ):
+    """Expand a grammar and compile its render plan.  Returns the plan
+    and the seed to place it with."""
+    if seed is None:
+        return render.compile_plan( expand( grammar ) ), None
+    expansionSeed, placementSeed = stage_seeds( seed )
+    graph = expand( grammar, seed = expansionSeed )
+    return render.compile_plan( graph ), placementSeed
+
+def render_grammar( grammar, seed = None, **options ):
+    """Expand a grammar and render it to an svgwrite Drawing.  The same
+    grammar and seed always give the same SVG; without a seed, the random
+    module is used.  Other options are passed to render.render_plan()."""
+    plan, placementSeed = compile_grammar( grammar, seed )
+    return render.render_plan( plan, seed = placementSeed, **options )
+
+def write_grammar( grammar, out, seed = None, pretty = False, **options ):
+    """As render_grammar(), but stream the SVG to out, a file name or
+    text file object, with render.write_plan()."""
+    plan, placementSeed = compile_grammar( grammar, seed )
+    render.write_plan( plan, out, pretty, seed = placementSeed, **options )
+
+def graph_to_json( graph ):
+    """The expanded graph as plain data: nodes with their tags, and
+    edges with theirs (None for an untagged edge)."""
+    return {
+        "nodes" : [ { "id" : n, "tag" : t }
+                    for n, t in graph.nodes( data="tag" ) ],
+        "edges" : [ { "source" : i, "target" : j, "tag" : t }
+                    for i, j, t in graph.edges( data="tag" ) ],
+    }
+
+# File suffixes dump_graph() can write
+dump_formats = ( ".svg", ".json" )
+
+def dump_graph( graph, path ):
+    """Write the expanded graph for debugging.  A .svg file is laid out
+    by graphviz, which can take much longer than rendering for large
+    graphs; a .json file is written directly."""
+    if path.suffix == ".svg":
+        # Graphviz is only needed for this debugging output.
+        import soffit.display as display
+        display.drawSvg( graph, str( path ) )
+    elif path.suffix == ".json":
+        with open( path, "w" ) as f:
+            json.dump( graph_to_json( graph ), f )
+    else:
+        raise Exception( "Unknown graph dump format {}, expected .svg or .json".format( path ) )
+
+def configure_logging( verbose ):
+    """Show warnings only, or with verbose, every subsystem's progress
+    messages."""
+    logging.basicConfig( level = logging.DEBUG if verbose else logging.WARNING,
+                         format = "%(name)s: %(message)s" )
+
+def init_process( verbose ):
+    """Set up the CLI, or a batch worker process."""
+    configure_logging( verbose )
+    render.precompile_attribute_table()
+
+def render_one( grammarFile, seed, outputFile, pretty = False, **options ):
+    """Expand and render one variant of a grammar, and write it out, with
+    options as for write_grammar().  Runs in a worker process in batch
+    mode; returns the output file, the error message or None, and the
+    time taken."""
+    start = time.perf_counter()
+    try:
+        write_grammar( load_grammar( grammarFile ), outputFile, seed, pretty,
+                       **options )
+        error = None
+    except Exception as e:
+        error = "{}: {}".format( type( e ).__name__, e )
+    return outputFile, error, time.perf_counter() - start
+
+def parse_seeds( text ):
+    """Parse a seed range "START:STOP" (STOP excluded) or a single seed."""
+    if ":" in text:
+        start, stop = text.split( ":", 1 )
+        return range( int( start ), int( stop ) )
+    return [ int( text ) ]
+
+def batch_items( grammarFiles, seeds, outputDir ):
+    for grammarFile in grammarFiles:
+        directory = outputDir if outputDir is not None else grammarFile.parent
+        for seed in seeds:
+            if seed is None:
+                name = grammarFile.stem + ".svg"
+            else:
+                name = "{}-{}.svg".format( grammarFile.stem, seed )
+            yield grammarFile, seed, directory / name
+
+def output_clashes( items ):
+    """Pairs of grammar files in batch_items() that would write the same
+    output file, such as two with the same name under --output-dir."""
+    written = {}
+    clashes = []
+    for grammarFile, seed, outputFile in items:
+        if outputFile in written and written[outputFile] != grammarFile:
+            clashes.append( ( written[outputFile], grammarFile, outputFile ) )
+        written.setdefault( outputFile, grammarFile )
+    return clashes
+
+def placement_options( args ):
+    """Options for render.write_plan() from the placement arguments."""
+    return { "solver_class" : solver_class( args.solver ),
+             "chains" : args.chains }
+
+def run_batch( args, items ):
+    if args.output_dir is not None:
+        args.output_dir.mkdir( parents = True, exist_ok = True )
+
+    failures = 0
+    total = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+            args.jobs, initializer = init_process,
+            initargs = ( args.verbose, ) ) as executor:
+        futures = [ executor.submit( render_one, *item, args.pretty,
+                                     **placement_options( args ) )
+                    for item in items ]
+        for f in concurrent.futures.as_completed( futures ):
+            outputFile, error, elapsed = f.result()
+            if error is None:
+                print( "ok     {:8.2f}s {}".format( elapsed, outputFile ) )
+            else:
+                failures += 1
+                print( "FAILED {:8.2f}s {}: {}".format( elapsed, outputFile, error ) )
+            sys.stdout.flush()
+
+    print( "{} rendered, {} failed, in {:.2f}s".format(
+        len( items ) - failures, failures, time.perf_counter() - total ) )
+    return 1 if failures else 0
+
 def main():
-    if len( sys.argv ) < 2 or len( sys.argv ) > 3:
-        print( "Usage: python -m svgrammar <grammar file> [<output file>]" )
-        sys.exit( 1 )
+    parser = argparse.ArgumentParser(
+        prog = "python -m svgrammar",
+        description = "Expand a soffit grammar and render it as SVG." )
+    parser.add_argument( "files", nargs = "+", type = Path,
+                         help = "<grammar file> [<output file>], or with "
+                         "--batch, any number of grammar files.  A .plan "
+                         "file saved by --save-plan is rendered without "
+                         "expanding the grammar again" )
+    parser.add_argument( "--batch", action = "store_true",
+                         help = "render every grammar file, once per seed, "
+                         "in a pool of worker processes" )
+    parser.add_argument( "--seeds", metavar = "START:STOP",
+                         help = "batch mode: render one variant per seed "
+                         "in this range" )
+    parser.add_argument( "--seed", type = int, default = None,
+                         help = "seed for grammar expansion and placement; "
+                         "the same seed always gives the same output" )
+    parser.add_argument( "--dump-graph", type = Path, metavar = "PATH",
+                         help = "write the expanded graph to PATH, as a "
+                         "graphviz drawing (.svg) or as JSON (.json)" )
+    parser.add_argument( "--save-plan", type = Path, metavar = "PATH",
+                         help = "save the compiled render plan to PATH" )
+    parser.add_argument( "--jobs", type = int, default = None,
+                         help = "batch mode: number of worker processes "
+                         "(default: one per CPU)" )
+    parser.add_argument( "--output-dir", type = Path, default = None,
+                         help = "batch mode: directory for the output files "
+                         "(default: next to each grammar file)" )
+    parser.add_argument( "--workers", type = int, default = None,
+                         help = "solve the placement problems in a pool of "
+                         "this many worker processes" )
+    parser.add_argument( "--chains", type = int, default = 1,
+                         help = "solve each placement problem by parallel "
+                         "tempering with this many chains (default: 1, "
+                         "plain annealing)" )
+    parser.add_argument( "--solver", choices = [ "python", "numpy" ],
+                         default = "python",
+                         help = "placement solver: pure Python, or array-"
+                         "based, which needs numpy (default: python)" )
+    parser.add_argument( "--pretty", action = "store_true",
+                         help = "indent the SVG output, one element per line" )
+    parser.add_argument( "--verbose", "-v", action = "store_true",
+                         help = "log rendering and placement progress" )
+    # Intermixed, so options may come between the input and output files
+    args = parser.parse_intermixed_args()
+    if args.dump_graph is not None and args.dump_graph.suffix not in dump_formats:
+        # Before the expansion, which can take a while
+        parser.error( "unknown --dump-graph format {}, expected .svg or .json".format(
+            args.dump_graph ) )
+    if args.chains < 1:
+        parser.error( "--chains must be at least 1" )
+    init_process( args.verbose )
 
-    grammarFile = Path( sys.argv[1] )
-    if len( sys.argv ) > 2:
-        outputFile = Path( sys.argv[2] )
+    if args.batch:
+        if args.dump_graph is not None or args.save_plan is not None:
+            parser.error( "--dump-graph and --save-plan are not supported "
+                          "with --batch" )
+        if args.workers is not None:
+            parser.error( "--workers is not supported with --batch, which "
+                          "already renders in a pool of processes; see --jobs" )
+        seeds = parse_seeds( args.seeds ) if args.seeds is not None else [ args.seed ]
+        items = list( batch_items( args.files, seeds, args.output_dir ) )
+        for first, second, outputFile in output_clashes( items ):
+            parser.error( "{} and {} would both be written to {}".format(
+                first, second, outputFile ) )
+        sys.exit( run_batch( args, items ) )
+
+    for option, value in ( ( "--seeds", args.seeds ), ( "--jobs", args.jobs ),
+                           ( "--output-dir", args.output_dir ) ):
+        if value is not None:
+            parser.error( "{} is only supported with --batch".format( option ) )
+
+    if len( args.files ) > 2:
+        parser.error( "expected <grammar file> [<output file>]; "
+                      "use --batch for several grammar files" )
+
+    grammarFile = args.files[0]
+    if len( args.files ) > 1:
+        outputFile = args.files[1]
     else:
         outputFile = grammarFile.with_suffix( ".svg" )
-            
-    grammar = soffit.loadGrammar( grammarFile )
-    a = soffit.ApplicationState( grammar = grammar,
-                                 initialGraph = grammar.start )
-    a.run( 1000 )
-
-    display.drawSvg( a.graph, "expanded-graph.svg" )
-    d = render.graph_to_svg( a.graph )
-    d.saveas( outputFile, pretty=True )
-    
+
+    if args.seed is None:
+        expansionSeed = placementSeed = None
+    else:
+        expansionSeed, placementSeed = stage_seeds( args.seed )
+
+    if grammarFile.suffix == ".plan":
+        if args.dump_graph is not None:
+            parser.error( "a saved plan has no expanded graph to dump" )
+        plan = load_plan( grammarFile )
+    else:
+        graph = expand( load_grammar( grammarFile ), seed = expansionSeed )
+        if args.dump_graph is not None:
+            dump_graph( graph, args.dump_graph )
+        plan = render.compile_plan( graph )
+        if args.save_plan is not None:
+            save_plan( plan, args.save_plan )
+    render.write_plan( plan, outputFile, args.pretty, seed = placementSeed,
+                       workers = args.workers, **placement_options( args ) )
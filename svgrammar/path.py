@@ -0,0 +1,501 @@
+"""SVG path data: parsing and exact bounds.
+
+parse_path() turns a path's "d" attribute into a tuple of absolute
+commands, each a tuple starting with its letter:
+
+    ("M", x, y)
+    ("L", x, y)
+    ("C", x1, y1, x2, y2, x, y)
+    ("Q", x1, y1, x, y)
+    ("A", rx, ry, rotation, large_arc, sweep, x, y)
+    ("Z", x, y)
+
+so every command ends with the point it leaves the pen at; for "Z" that
+is the start of the subpath it closes.
+
+Relative commands are made absolute, H and V become L, and S and T
+become C and Q with their reflected control points, so later processing
+only has to handle these six.  path_bounds() computes the exact bounds of
+the commands, including the extrema of curves and arcs, optionally after
+an affine transform.  For long paths, PathArrays holds the same commands
+as numpy arrays and computes the same bounds over whole arrays at once.
+"""
+import functools
+import itertools
+import math
+import operator
+import re
+from .transform import apply, identity
+
+# numpy is only needed for long paths, and importing it adds noticeably to
+# startup time, so it is imported on first use by have_numpy().
+numpy = None
+numpy_missing = False
+
+def have_numpy():
+    """Import numpy, if it is installed; returns whether it is."""
+    global numpy, numpy_missing
+    if numpy is None and not numpy_missing:
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            numpy_missing = True
+    return numpy is not None
+
+token_re = re.compile( r"([MmZzLlHhVvCcSsQqTtAa])|"
+                       r"([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|"
+                       r"([^\s,])" )
+
+# Number of arguments of each command
+arities = { "M" : 2, "L" : 2, "H" : 1, "V" : 1, "C" : 6, "S" : 4,
+            "Q" : 4, "T" : 2, "A" : 7, "Z" : 0 }
+
+def tokenize( d ):
+    """Split path data into command letters and number strings."""
+    tokens = []
+    for command, number, junk in token_re.findall( d ):
+        if junk:
+            raise Exception( "Unhandled SVG path command '{}'".format( junk ) )
+        tokens.append( command or number )
+    return tokens
+
+@functools.lru_cache( maxsize = 256 )
+def parse_path( d ):
+    tokens = tokenize( d )
+    commands = []
+    append = commands.append
+    x = y = 0.0
+    start_x = start_y = 0.0
+    # Control point of the previous C/S or Q/T, for reflecting
+    last_control = None
+    last_kind = None
+    command = None
+    i = 0
+    n = len( tokens )
+    while i < n:
+        t = tokens[i]
+        if t.isalpha():
+            command = t
+            i += 1
+            if command in "Zz":
+                x, y = start_x, start_y
+                append( ("Z", x, y) )
+                last_kind = None
+                continue
+        elif command is None or command in "Zz":
+            raise Exception( "SVG path data '{}' has numbers without a command".format( d[:40] ) )
+
+        upper = command.upper()
+        relative = command != upper
+        if upper == "A":
+            # The two flags may be written without separators, as in
+            # "a1,1 0 1010,10", which reads as one number token
+            args = []
+            for k in range( 7 ):
+                if i == n or tokens[i].isalpha():
+                    raise Exception( "Incomplete SVG path command '{}'".format( command ) )
+                t = tokens[i]
+                if k in ( 3, 4 ) and len( t ) > 1 and t[0] in "01":
+                    tokens[i] = t[1:]
+                    args.append( float( t[0] ) )
+                    continue
+                args.append( float( t ) )
+                i += 1
+        else:
+            count = arities[upper]
+            if i + count > n:
+                raise Exception( "Incomplete SVG path command '{}'".format( command ) )
+            args = []
+            for k in range( count ):
+                t = tokens[i + k]
+                if t.isalpha():
+                    raise Exception( "Incomplete SVG path command '{}'".format( command ) )
+                args.append( float( t ) )
+            i += count
+
+        kind = None
+        if upper == "M":
+            if relative:
+                x += args[0]
+                y += args[1]
+            else:
+                x, y = args
+            start_x, start_y = x, y
+            append( ("M", x, y) )
+            # Further coordinate pairs are implicit line commands
+            command = "l" if relative else "L"
+        elif upper == "L":
+            if relative:
+                x += args[0]
+                y += args[1]
+            else:
+                x, y = args
+            append( ("L", x, y) )
+        elif upper == "H":
+            x = x + args[0] if relative else args[0]
+            append( ("L", x, y) )
+        elif upper == "V":
+            y = y + args[0] if relative else args[0]
+            append( ("L", x, y) )
+        elif upper == "C" or upper == "S":
+            if upper == "C":
+                x1, y1, x2, y2, ex, ey = args
+                if relative:
+                    x1 += x
+                    y1 += y
+            else:
+                x2, y2, ex, ey = args
+                if last_kind == "C":
+                    x1 = 2 * x - last_control[0]
+                    y1 = 2 * y - last_control[1]
+                else:
+                    x1, y1 = x, y
+            if relative:
+                x2 += x
+                y2 += y
+                ex += x
+                ey += y
+            append( ("C", x1, y1, x2, y2, ex, ey) )
+            x, y = ex, ey
+            kind = "C"
+            last_control = (x2, y2)
+        elif upper == "Q" or upper == "T":
+            if upper == "Q":
+                x1, y1, ex, ey = args
+                if relative:
+                    x1 += x
+                    y1 += y
+            else:
+                ex, ey = args
+                if last_kind == "Q":
+                    x1 = 2 * x - last_control[0]
+                    y1 = 2 * y - last_control[1]
+                else:
+                    x1, y1 = x, y
+            if relative:
+                ex += x
+                ey += y
+            append( ("Q", x1, y1, ex, ey) )
+            x, y = ex, ey
+            kind = "Q"
+            last_control = (x1, y1)
+        else:
+            rx, ry, rotation, large, sweep, ex, ey = args
+            if relative:
+                ex += x
+                ey += y
+            append( ("A", rx, ry, rotation, large, sweep, ex, ey) )
+            x, y = ex, ey
+        last_kind = kind
+
+    return tuple( commands )
+
+def curve_range( lo, hi, p0, p1, p2, p3 ):
+    """Extend (lo, hi) to cover one coordinate of the cubic Bezier with
+    these control values, from the roots of its derivative."""
+    a = -p0 + 3 * p1 - 3 * p2 + p3
+    b = 2 * ( p0 - 2 * p1 + p2 )
+    c = p1 - p0
+    if a == 0.0:
+        roots = [ -c / b ] if b != 0.0 else []
+    else:
+        disc = b * b - 4 * a * c
+        if disc < 0.0:
+            roots = []
+        else:
+            s = math.sqrt( disc )
+            roots = [ ( -b + s ) / ( 2 * a ), ( -b - s ) / ( 2 * a ) ]
+    for t in roots:
+        if 0.0 < t < 1.0:
+            u = 1.0 - t
+            v = u * u * u * p0 + 3 * u * u * t * p1 + 3 * u * t * t * p2 + t * t * t * p3
+            if v < lo:
+                lo = v
+            if v > hi:
+                hi = v
+    return lo, hi
+
+def quad_range( lo, hi, p0, p1, p2 ):
+    """As curve_range(), for a quadratic Bezier."""
+    denom = p0 - 2 * p1 + p2
+    if denom != 0.0:
+        t = ( p0 - p1 ) / denom
+        if 0.0 < t < 1.0:
+            u = 1.0 - t
+            v = u * u * p0 + 2 * u * t * p1 + t * t * p2
+            if v < lo:
+                lo = v
+            if v > hi:
+                hi = v
+    return lo, hi
+
+def arc_center( x1, y1, rx, ry, rotation, large, sweep, x2, y2 ):
+    """Convert an arc from (x1,y1) to (x2,y2) to centre form, following
+    the SVG specification's implementation notes.  Returns the centre c,
+    vectors u and v such that the arc is c + u cos(t) + v sin(t), and the
+    start angle and sweep of t; or None if the arc is a straight line."""
+    if x1 == x2 and y1 == y2:
+        return None
+    rx = abs( rx )
+    ry = abs( ry )
+    if rx == 0.0 or ry == 0.0:
+        return None
+    phi = math.radians( rotation )
+    cos = math.cos( phi )
+    sin = math.sin( phi )
+    dx = ( x1 - x2 ) / 2
+    dy = ( y1 - y2 ) / 2
+    x1p = cos * dx + sin * dy
+    y1p = -sin * dx + cos * dy
+
+    # Scale up radii that are too small to reach
+    scale = ( x1p * x1p ) / ( rx * rx ) + ( y1p * y1p ) / ( ry * ry )
+    if scale > 1.0:
+        scale = math.sqrt( scale )
+        rx *= scale
+        ry *= scale
+
+    num = rx * rx * ry * ry - rx * rx * y1p * y1p - ry * ry * x1p * x1p
+    den = rx * rx * y1p * y1p + ry * ry * x1p * x1p
+    coef = math.sqrt( max( 0.0, num / den ) )
+    if ( large != 0.0 ) == ( sweep != 0.0 ):
+        coef = -coef
+    cxp = coef * rx * y1p / ry
+    cyp = -coef * ry * x1p / rx
+    cx = cos * cxp - sin * cyp + ( x1 + x2 ) / 2
+    cy = sin * cxp + cos * cyp + ( y1 + y2 ) / 2
+
+    start = math.atan2( ( y1p - cyp ) / ry, ( x1p - cxp ) / rx )
+    end = math.atan2( ( -y1p - cyp ) / ry, ( -x1p - cxp ) / rx )
+    delta = end - start
+    if sweep != 0.0 and delta < 0.0:
+        delta += 2 * math.pi
+    elif sweep == 0.0 and delta > 0.0:
+        delta -= 2 * math.pi
+    return ( (cx, cy), (rx * cos, rx * sin), (-ry * sin, ry * cos),
+             start, delta )
+
+def arc_range( lo, hi, c, p, q, start, delta ):
+    """Extend (lo, hi) to cover c + p cos(t) + q sin(t) for t from start
+    through start + delta, whose extrema are at atan2(q, p) and opposite."""
+    if delta < 0.0:
+        start += delta
+        delta = -delta
+    peak = math.atan2( q, p )
+    amplitude = math.hypot( p, q )
+    for t, v in ( (peak, c + amplitude), (peak + math.pi, c - amplitude) ):
+        if ( t - start ) % ( 2 * math.pi ) <= delta:
+            if v < lo:
+                lo = v
+            if v > hi:
+                hi = v
+    return lo, hi
+
+def path_bounds( commands, m = identity ):
+    """The exact bounds (x1, y1, x2, y2) of parsed path commands after
+    the affine transform m, or None if there are none.  Move commands
+    count, even if nothing is drawn from them."""
+    a, b, c, d, e, f = m
+    plain = m == identity
+    x1 = y1 = math.inf
+    x2 = y2 = -math.inf
+    # Current point, untransformed and transformed
+    cx = cy = 0.0
+    tx, ty = e, f
+    for cmd in commands:
+        letter = cmd[0]
+        ex, ey = cmd[-2], cmd[-1]
+        if plain:
+            nx, ny = ex, ey
+        else:
+            nx = a * ex + c * ey + e
+            ny = b * ex + d * ey + f
+        if letter == "Z":
+            # Back to a point already counted
+            cx, cy, tx, ty = ex, ey, nx, ny
+            continue
+        if nx < x1:
+            x1 = nx
+        if nx > x2:
+            x2 = nx
+        if ny < y1:
+            y1 = ny
+        if ny > y2:
+            y2 = ny
+
+        if letter == "C":
+            if plain:
+                p1x, p1y, p2x, p2y = cmd[1:5]
+            else:
+                p1x, p1y = apply( m, cmd[1], cmd[2] )
+                p2x, p2y = apply( m, cmd[3], cmd[4] )
+            x1, x2 = curve_range( x1, x2, tx, p1x, p2x, nx )
+            y1, y2 = curve_range( y1, y2, ty, p1y, p2y, ny )
+        elif letter == "Q":
+            if plain:
+                p1x, p1y = cmd[1], cmd[2]
+            else:
+                p1x, p1y = apply( m, cmd[1], cmd[2] )
+            x1, x2 = quad_range( x1, x2, tx, p1x, nx )
+            y1, y2 = quad_range( y1, y2, ty, p1y, ny )
+        elif letter == "A":
+            arc = arc_center( cx, cy, *cmd[1:] )
+            if arc is not None:
+                (ox, oy), (ux, uy), (vx, vy), start, delta = arc
+                # Under an affine map the arc is still c + u cos + v sin
+                if not plain:
+                    ox, oy = apply( m, ox, oy )
+                    ux, uy = a * ux + c * uy, b * ux + d * uy
+                    vx, vy = a * vx + c * vy, b * vx + d * vy
+                x1, x2 = arc_range( x1, x2, ox, ux, vx, start, delta )
+                y1, y2 = arc_range( y1, y2, oy, uy, vy, start, delta )
+        cx, cy, tx, ty = ex, ey, nx, ny
+    if x1 > x2:
+        # Nothing but close commands
+        return None
+    return ( x1, y1, x2, y2 )
+
+class PathArrays(object):
+    """Parsed path commands as numpy arrays: every point the path passes
+    through, the control points of its curves, and its arcs in centre
+    form, from which bounds() works out the same bounds as path_bounds()
+    over whole arrays.  Building the arrays costs a pass over the
+    commands, so this only pays off for long paths."""
+    def __init__( self, commands ):
+        if not have_numpy():
+            raise ImportError( "PathArrays requires numpy" )
+        n = len( commands )
+        letters = numpy.frombuffer(
+            "".join( [ c[0] for c in commands ] ).encode( "ascii" ), dtype="S1" )
+        ends = numpy.fromiter(
+            itertools.chain.from_iterable(
+                map( operator.itemgetter( -2, -1 ), commands ) ),
+            float, 2 * n ).reshape( n, 2 )
+        starts = numpy.vstack( ( [ [ 0.0, 0.0 ] ], ends[:-1] ) )
+        # A close command returns to a point already counted
+        self.points = ends[letters != b"Z"]
+
+        def arguments( indices, first, last ):
+            # The arguments first:last of the given commands, as rows
+            get = operator.itemgetter( *range( first, last ) )
+            return numpy.fromiter(
+                itertools.chain.from_iterable(
+                    get( commands[i] ) for i in indices.tolist() ),
+                float, len( indices ) * ( last - first ) ).reshape(
+                    len( indices ), last - first )
+
+        cubic = numpy.flatnonzero( letters == b"C" )
+        self.cubic = numpy.empty( (len( cubic ), 4, 2) )
+        self.cubic[:,0] = starts[cubic]
+        self.cubic[:,1:3] = arguments( cubic, 1, 5 ).reshape( -1, 2, 2 )
+        self.cubic[:,3] = ends[cubic]
+
+        quad = numpy.flatnonzero( letters == b"Q" )
+        self.quad = numpy.empty( (len( quad ), 3, 2) )
+        self.quad[:,0] = starts[quad]
+        self.quad[:,1] = arguments( quad, 1, 3 )
+        self.quad[:,2] = ends[quad]
+
+        arc = numpy.flatnonzero( letters == b"A" )
+        self.set_arcs( starts[arc], arguments( arc, 1, 8 ) )
+
+    def set_arcs( self, starts, args ):
+        """Convert arcs to centre form, as arc_center() does for one."""
+        x1, y1 = starts.T
+        rx, ry, rotation, large, sweep, x2, y2 = args.T
+        rx = numpy.abs( rx )
+        ry = numpy.abs( ry )
+        curved = ( ( x1 != x2 ) | ( y1 != y2 ) ) & ( rx != 0.0 ) & ( ry != 0.0 )
+        x1, y1, rx, ry, rotation, large, sweep, x2, y2 = \
+            [ a[curved] for a in ( x1, y1, rx, ry, rotation, large, sweep, x2, y2 ) ]
+
+        phi = numpy.radians( rotation )
+        cos = numpy.cos( phi )
+        sin = numpy.sin( phi )
+        dx = ( x1 - x2 ) / 2
+        dy = ( y1 - y2 ) / 2
+        x1p = cos * dx + sin * dy
+        y1p = -sin * dx + cos * dy
+
+        scale = numpy.sqrt( numpy.maximum(
+            ( x1p * x1p ) / ( rx * rx ) + ( y1p * y1p ) / ( ry * ry ), 1.0 ) )
+        rx = rx * scale
+        ry = ry * scale
+
+        num = rx * rx * ry * ry - rx * rx * y1p * y1p - ry * ry * x1p * x1p
+        den = rx * rx * y1p * y1p + ry * ry * x1p * x1p
+        coef = numpy.sqrt( numpy.maximum( 0.0, num / den ) )
+        coef = numpy.where( ( large != 0.0 ) == ( sweep != 0.0 ), -coef, coef )
+        cxp = coef * rx * y1p / ry
+        cyp = -coef * ry * x1p / rx
+
+        start = numpy.arctan2( ( y1p - cyp ) / ry, ( x1p - cxp ) / rx )
+        end = numpy.arctan2( ( -y1p - cyp ) / ry, ( -x1p - cxp ) / rx )
+        delta = end - start
+        delta = numpy.where( ( sweep != 0.0 ) & ( delta < 0.0 ), delta + 2 * math.pi, delta )
+        delta = numpy.where( ( sweep == 0.0 ) & ( delta > 0.0 ), delta - 2 * math.pi, delta )
+        # Sweep forwards from whichever end comes first
+        start = numpy.where( delta < 0.0, start + delta, start )
+
+        self.arc_center = numpy.stack( ( cos * cxp - sin * cyp + ( x1 + x2 ) / 2,
+                                         sin * cxp + cos * cyp + ( y1 + y2 ) / 2 ), axis=1 )
+        self.arc_u = numpy.stack( ( rx * cos, rx * sin ), axis=1 )
+        self.arc_v = numpy.stack( ( -ry * sin, ry * cos ), axis=1 )
+        self.arc_start = start[:,None]
+        self.arc_delta = numpy.abs( delta )[:,None]
+
+    def bounds( self, m = identity ):
+        """As path_bounds( commands, m )."""
+        if len( self.points ) == 0:
+            return None
+        a, b, c, d, e, f = m
+        linear = numpy.array( [ [ a, b ], [ c, d ] ] )
+        offset = numpy.array( [ e, f ] )
+        points = self.points @ linear + offset
+        lo = points.min( axis=0 )
+        hi = points.max( axis=0 )
+
+        # Per coordinate, each array below is indexed [curve, axis].
+        # Where there is no extremum, t = 1 gives the end point, which is
+        # already counted.
+        if len( self.cubic ):
+            p0, p1, p2, p3 = numpy.moveaxis( self.cubic @ linear + offset, 1, 0 )
+            qa = -p0 + 3 * p1 - 3 * p2 + p3
+            qb = 2 * ( p0 - 2 * p1 + p2 )
+            qc = p1 - p0
+            with numpy.errstate( divide="ignore", invalid="ignore" ):
+                root = numpy.sqrt( qb * qb - 4 * qa * qc )
+                roots = numpy.where( qa != 0.0,
+                                     [ ( -qb + root ) / ( 2 * qa ),
+                                       ( -qb - root ) / ( 2 * qa ) ],
+                                     -qc / qb )
+            t = numpy.where( ( roots > 0.0 ) & ( roots < 1.0 ), roots, 1.0 )
+            u = 1.0 - t
+            values = u * u * u * p0 + 3 * u * u * t * p1 + 3 * u * t * t * p2 + t * t * t * p3
+            lo = numpy.minimum( lo, values.min( axis=(0, 1) ) )
+            hi = numpy.maximum( hi, values.max( axis=(0, 1) ) )
+
+        if len( self.quad ):
+            p0, p1, p2 = numpy.moveaxis( self.quad @ linear + offset, 1, 0 )
+            with numpy.errstate( divide="ignore", invalid="ignore" ):
+                t = ( p0 - p1 ) / ( p0 - 2 * p1 + p2 )
+            t = numpy.where( ( t > 0.0 ) & ( t < 1.0 ), t, 1.0 )
+            u = 1.0 - t
+            values = u * u * p0 + 2 * u * t * p1 + t * t * p2
+            lo = numpy.minimum( lo, values.min( axis=0 ) )
+            hi = numpy.maximum( hi, values.max( axis=0 ) )
+
+        if len( self.arc_center ):
+            center = self.arc_center @ linear + offset
+            p = self.arc_u @ linear
+            q = self.arc_v @ linear
+            peak = numpy.arctan2( q, p )
+            amplitude = numpy.hypot( p, q )
+            for t, v in ( ( peak, center + amplitude ),
+                          ( peak + math.pi, center - amplitude ) ):
+                inside = ( t - self.arc_start ) % ( 2 * math.pi ) <= self.arc_delta
+                lo = numpy.minimum( lo, numpy.where( inside, v, math.inf ).min( axis=0 ) )
+                hi = numpy.maximum( hi, numpy.where( inside, v, -math.inf ).max( axis=0 ) )
+
+        return ( float( lo[0] ), float( lo[1] ), float( hi[0] ), float( hi[1] ) )
@@ -1,61 +1,426 @@
+import logging
 import math
 import random
-import networkx as nx
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from collections import ChainMap, namedtuple, deque
+from .spatial import UniformGrid, cell_size_for
+
+# Bounding box copied out of the graph by Solver.detach()
+Box = namedtuple( "Box", [ "x1", "y1", "x2", "y2" ] )
+
+logger = logging.getLogger( __name__ )
+
+class GeometricSchedule(object):
+    """Multiply the temperature by a constant factor after every step."""
+    def __init__( self, factor = 0.95 ):
+        self.factor = factor
+
+    def next_temperature( self, temperature, acceptance ):
+        return temperature * self.factor
+
+class AdaptiveSchedule(object):
+    """Cool slowly while the acceptance ratio of the last step is in the
+    range [low, high], where most of the useful search happens, and
+    quickly while nearly every move is accepted (too hot to matter) or
+    nearly none are (frozen)."""
+    def __init__( self, slow = 0.95, fast = 0.8, low = 0.05, high = 0.8 ):
+        self.slow = slow
+        self.fast = fast
+        self.low = low
+        self.high = high
+
+    def next_temperature( self, temperature, acceptance ):
+        if self.low <= acceptance <= self.high:
+            return temperature * self.slow
+        else:
+            return temperature * self.fast
 
 class Solver(object):
+    # Whether the all_disjoint option works with this solver; see
+    # render.build_layout()
+    supports_all_disjoint = True
+
+    # Options copied by empty_copy() and accepted by configure()
+    settings = ( "primary_scale", "secondary_scale", "verbose",
+                 "incremental", "check_incremental",
+                 "schedule", "min_temperature", "max_accepts",
+                 "stagnation_steps", "stagnation_tolerance", "stop_at_zero",
+                 "exact", "exact_tolerance", "all_disjoint",
+                 "trace", "trace_every", "trace_limit" )
+    
     def __init__( self, graph ):
         self.movable = set()
         self.fixed = set()
         self.relations = []
+        self.index = {}
+        self.members = {}
+        # Bounding boxes are read from the "drawn" elements of the graph,
+        # or if boxes is set, looked up in it by node.
         self.graph = graph
+        self.boxes = None
 
         self.temperature = 0.0
         self.current = None
         self.current_penalty = None
+        self.current_terms = None
+        self.term_units = None
+        self.current_pairs = None
+        self.grid = None
         self.best = None
+        self.best_undo = None
         self.best_penalty = None
         self.best_temperature = None
 
         self.primary_scale = 10.0
         self.secondary_scale = 1.0
 
+        # Source of randomness; the random module itself unless a
+        # random.Random instance is supplied.
+        self.rng = random
+
+        # History of accepted moves, for debugging: trace is "off",
+        # "sampled" to keep every trace_every'th accepted move, or "full".
+        # If trace_limit is set only that many of the most recent are
+        # kept.
+        self.trace = "off"
+        self.trace_every = 100
+        self.trace_limit = None
+        self.trace_count = 0
+        self.movable_list = []
         self.paths = {}
         self.penalties = []
         self.temps = []
         self.verbose = False
+
+        # Only re-score the relations touching the moved elements on
+        # each annealing step; check_incremental compares every
+        # incremental score against a full penalty() call.
+        self.incremental = True
+        self.check_incremental = False
+
+        # Annealing stops once the temperature falls below
+        # min_temperature, or after stagnation_steps temperature steps
+        # (if not None) that each improve the best penalty by less than
+        # the fraction stagnation_tolerance, or as soon as the penalty
+        # reaches zero (if stop_at_zero.)  At most max_accepts moves are
+        # accepted per temperature step.
+        self.schedule = GeometricSchedule()
+        self.min_temperature = 0.1
+        self.max_accepts = 100
+        self.stagnation_steps = None
+        self.stagnation_tolerance = 1e-3
+        self.stop_at_zero = True
+        self.stale_steps = 0
+
+        # Try exact_solution() before annealing; its result is accepted
+        # if the penalty is at most exact_tolerance.
+        self.exact = True
+        self.exact_tolerance = 1e-6
+
+        # Penalize any overlap between two members of the group, as if
+        # every pair had a "disjoint" relation.  A grid index finds the
+        # pairs that actually overlap.
+        self.all_disjoint = False
         
+    def configure( self, **options ):
+        for k, v in options.items():
+            if k not in self.settings:
+                raise Exception( "Unknown solver option '{}'".format( k ) )
+            setattr( self, k, v )
+        return self
+
     def add_edge( self, e1, relation, e2 ):
         # e2 is considered fixed, e1 is variable
         # read the relation as "e1 is to <adjacent to the left side of> e2"
         self.movable.add( e1 )
         self.fixed.add( e2 )
+        self.members[e1] = None
+        self.members[e2] = None
+        self.index.setdefault( e1, [] ).append( len( self.relations ) )
+        if e2 != e1:
+            self.index.setdefault( e2, [] ).append( len( self.relations ) )
         self.relations.append( (e1, relation, e2) )
         # TODO: this allows A->B and A->C without forcing an ordering
         # of B<->C, so they could overlap; is this OK?
 
+    def add_element( self, e ):
+        """Add a member of the group that may have no relations; it is
+        only used by all_disjoint, where every member may be moved to
+        keep it clear of the others."""
+        self.members[e] = None
+        self.movable.add( e )
+
+    def movable_order( self ):
+        """The movable elements in a stable order, for random.sample: the
+        ones with relations first, as they were added."""
+        order = dict.fromkeys( a for a, r, b in self.relations )
+        for e in self.members:
+            if e in self.movable:
+                order[e] = None
+        return list( order )
+
+    def empty_copy( self ):
+        """Return a solver with the same settings, but no relations."""
+        s = self.__class__( self.graph )
+        s.boxes = self.boxes
+        s.rng = self.rng
+        for k in self.settings:
+            setattr( s, k, getattr( self, k ) )
+        return s
+
+    def components( self ):
+        """Split the relations into independent sub-problems, one per
+        connected component of the movable elements.  Fixed elements never
+        move, so two clusters that only share a fixed element are still
+        independent.  With all_disjoint every member may collide with
+        every other, so there is only one component, even if there are no
+        relations.  Members with an empty box take no space, so are left
+        out of it."""
+        if self.all_disjoint:
+            c = self.copy_relations()
+            return [ c ] if len( c.movable ) else []
+        parent = {}
+        def find( n ):
+            while parent[n] != n:
+                parent[n] = parent[parent[n]]
+                n = parent[n]
+            return n
+
+        for a, r, b in self.relations:
+            parent.setdefault( a, a )
+            if b in self.movable:
+                parent.setdefault( b, b )
+                ra, rb = find( a ), find( b )
+                if ra != rb:
+                    parent[rb] = ra
+
+        solvers = {}
+        for a, r, b in self.relations:
+            root = find( a )
+            if root not in solvers:
+                solvers[root] = self.empty_copy()
+            solvers[root].add_edge( a, r, b )
+        return list( solvers.values() )
+
+    def solve( self ):
+        """Solve each component separately, with its own temperature and
+        iteration count, and combine their best positions."""
+        self.best = {}
+        self.best_penalty = 0.0
+        for c in self.components():
+            c.solve_component()
+            self.best.update( c.best )
+            self.best_penalty += c.best_penalty
+        return self.best
+
+    def solve_component( self, chains = 1 ):
+        """Solve a single component; directly if exact_solution() finds
+        an answer, otherwise by annealing, or by parallel tempering if
+        chains is more than one."""
+        if self.exact:
+            positions = self.exact_solution()
+            if positions is not None:
+                self.current = self.best = positions
+                self.current_penalty = self.best_penalty = \
+                    Solver.penalty( self, positions )
+                logger.debug( "exact placement, penalty: %s", self.best_penalty )
+                # The trace is the one state found
+                self.start_trace()
+                self.record()
+                return self.best
+
+        if chains > 1:
+            self.tempering( chains )
+        else:
+            self.start()
+            self.annealing()
+        return self.best
+
+    def exact_offset( self, a, relation, b, positions ):
+        """Return the translation of 'a' that makes the distance term of
+        the relation zero, given the position of 'b', or None for
+        relations like "disjoint" that have no distance term."""
+        if relation in ( "adjacent-left", "place-left" ):
+            ma = self.right_midpoint( a, positions )
+            mb = self.left_midpoint( b, positions )
+        elif relation in ( "adjacent-right", "place-right" ):
+            ma = self.left_midpoint( a, positions )
+            mb = self.right_midpoint( b, positions )
+        elif relation in ( "adjacent-above", "place-above" ):
+            ma = self.lower_midpoint( a, positions )
+            mb = self.upper_midpoint( b, positions )
+        elif relation in ( "adjacent-below", "place-below" ):
+            ma = self.upper_midpoint( a, positions )
+            mb = self.lower_midpoint( b, positions )
+        else:
+            return None
+        return ( positions[a][0] + mb[0] - ma[0],
+                 positions[a][1] + mb[1] - ma[1] )
+
+    def exact_solution( self ):
+        """Try to place the movable elements without any search.
+
+        Each movable element is anchored by its first relation that has a
+        distance term, and placed exactly where that term is zero, after
+        the element it is anchored to.  This only works if the anchors
+        are acyclic, and the result is only used if every relation,
+        including the others for the same element and any "disjoint"
+        ones, then has (almost) zero penalty.  Returns the positions, or
+        None if the constraints are cyclic or inconsistent."""
+        self.fixed.difference_update( self.movable )
+        self.movable_list = self.movable_order()
+        anchors = {}
+        for a, r, b in self.relations:
+            if a not in anchors and r != "disjoint":
+                anchors[a] = ( r, b )
+
+        # Depth-first search for an order where each element comes after
+        # its anchor.
+        order = []
+        state = {}
+        for m in self.movable_list:
+            stack = [m]
+            while len( stack ) > 0:
+                n = stack[-1]
+                if state.get( n ) == "done":
+                    stack.pop()
+                    continue
+                dep = anchors[n][1] if n in anchors else None
+                if dep in self.movable and state.get( dep ) != "done":
+                    if state.get( dep ) == "active":
+                        return None
+                    state[n] = "active"
+                    stack.append( dep )
+                    continue
+                state[n] = "done"
+                order.append( n )
+                stack.pop()
+
+        positions = self.initial_positions()
+        for m in order:
+            if m in anchors:
+                r, b = anchors[m]
+                positions[m] = self.exact_offset( m, r, b, positions )
+
+        # Uses the pure-Python penalty, which doesn't need start() first.
+        if Solver.penalty( self, positions ) > self.exact_tolerance:
+            return None
+        return positions
+
+    def detach( self ):
+        """Copy the bounding boxes out of the graph and drop the reference
+        to it, so that the solver can be pickled and sent to a worker
+        process.  The random module can't be pickled either, so unless
+        the solver has its own random.Random it is dropped too; see
+        solve_detached()."""
+        boxes = {}
+        for n in self.members:
+            bb = self.bounding_box( n )
+            boxes[n] = Box( bb.x1, bb.y1, bb.x2, bb.y2 )
+        self.boxes = boxes
+        self.graph = None
+        if self.rng is random:
+            self.rng = None
+        return self
+
     def bounding_box( self, n ):
+        if self.boxes is not None:
+            return self.boxes[n]
         return self.graph.nodes[n]["drawn"].bounding_box
         
-    def start( self ):
-        self.fixed.difference_update( self.movable )
+    def initial_positions( self, scatter = False ):
+        """Every movable element at the origin, or, with all_disjoint, the
+        members in rows of cells as large as the largest of them, so that
+        they start clear of each other; stacked at the origin every pair
+        would be a candidate for the grid.  If scatter is true, each is
+        then displaced at random by up to a few times its size."""
+        spread = math.sqrt( len( self.movable_list ) )
+        boxes = [ self.bounding_box( m ) for m in self.movable_list ]
+        cell = 0.0
+        columns = 1
+        if self.all_disjoint and len( boxes ) > 0:
+            cell = max( max( bb.x2 - bb.x1, bb.y2 - bb.y1 ) for bb in boxes )
+            columns = math.ceil( spread )
         positions = {}
-        for m in self.movable:
-            bb = self.bounding_box( m )
-            positions[m] = (0.0, 0.0)
-            self.paths[m] = []
+        for i, ( m, bb ) in enumerate( zip( self.movable_list, boxes ) ):
+            x = 0.0
+            y = 0.0
+            if cell > 0.0:
+                x = ( i % columns ) * cell - bb.x1
+                y = ( i // columns ) * cell - bb.y1
+            if scatter:
+                x += self.rng.uniform( -spread, spread ) * ( bb.x2 - bb.x1 )
+                y += self.rng.uniform( -spread, spread ) * ( bb.y2 - bb.y1 )
+            positions[m] = ( x, y )
+        return positions
+
+    def start( self, scatter = False ):
+        """Set up the initial state, from initial_positions()."""
+        self.fixed.difference_update( self.movable )
+        self.start_trace()
+        positions = self.initial_positions( scatter )
+        self.member_list = list( self.members )
+        self.member_id = { n : i for i, n in enumerate( self.member_list ) }
         self.current = positions
-        self.current_penalty = self.penalty( self.current )
-        self.best = self.current
+        self.set_terms( self.penalty_terms( self.current ) )
+        units = self.term_units
+        if self.all_disjoint:
+            self.grid = self.build_grid( self.current )
+            self.set_pairs( self.pair_terms( self.current, self.grid ) )
+            units += self.pair_units
+        self.current_penalty = units / exact_scale
+        self.best = dict( self.current )
+        self.best_undo = {}
         self.best_penalty = self.current_penalty
 
-        print( "Intial positions:", positions )
-        print( "Initial penalty:", self.penalty( positions ) )
+        logger.debug( "initial positions: %s", positions )
+        logger.debug( "initial penalty: %s", self.current_penalty )
         self.temperature = self.initial_temperature()
-        print( "Intial temperature:", self.temperature )
+        logger.debug( "initial temperature: %s", self.temperature )
         self.best_temperature = self.temperature
 
+    def start_trace( self ):
+        """Start an empty history of the movable elements."""
+        self.movable_list = self.movable_order()
+        self.paths = { m : self.new_trace() for m in self.movable_list }
+        self.penalties = self.new_trace()
+        self.temps = self.new_trace()
+        self.trace_count = 0
+
+    def new_trace( self ):
+        if self.trace_limit is not None:
+            return deque( maxlen = self.trace_limit )
+        return []
+
+    def record( self ):
+        """Add the current state to the history, if tracing."""
+        if self.trace == "off":
+            return
+        self.trace_count += 1
+        if self.trace == "sampled" and \
+           ( self.trace_count - 1 ) % self.trace_every != 0:
+            return
+        for m in self.movable_list:
+            self.paths[m].append( self.current[m] )
+        self.penalties.append( self.current_penalty )
+        self.temps.append( self.temperature )
+
+    def export_trace( self, filename ):
+        """Save the history to a compressed numpy .npz file, with arrays
+        'nodes', 'paths' (step, node, x/y), 'penalties' and 'temps'.
+        The arrays are empty if the solver was never started."""
+        import numpy
+        numpy.savez_compressed(
+            filename,
+            nodes = numpy.array( [ str( m ) for m in self.movable_list ] ),
+            paths = numpy.array( [ list( self.paths[m] )
+                                   for m in self.movable_list ],
+                                 dtype = float ).reshape(
+                                     len( self.movable_list ),
+                                     len( self.penalties ), 2
+                                 ).transpose( 1, 0, 2 ),
+            penalties = numpy.array( self.penalties, dtype = float ),
+            temps = numpy.array( self.temps, dtype = float ) )
+
     def boundary_in( self, n, positions ):
         bb = self.bounding_box( n )
         if n in self.movable:
@@ -113,62 +478,188 @@ class Solver(object):
         x1, y1, x2, y2 = self.boundary_in( n, positions )
         return ( (x1 + x2) / 2.0, y1 )
                   
+    def relation_penalty( self, relation, positions ):
+        a, r, b = relation
+        overlap = self.overlap_in( a, b, positions )
+
+        # TODO: maybe midpoint distance is the wrong thing,
+        # we should weight gap between edges more heavily?
+        if r == "adjacent-left":
+            mb = self.left_midpoint( b, positions )
+            ma = self.right_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.primary_scale + \
+                overlap * self.secondary_scale
+        elif r == "adjacent-right":
+            mb = self.right_midpoint( b, positions )
+            ma = self.left_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.primary_scale + \
+                overlap * self.secondary_scale
+        elif r == "adjacent-above":
+            mb = self.upper_midpoint( b, positions )
+            ma = self.lower_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.primary_scale + \
+                overlap * self.secondary_scale
+        elif r == "adjacent-below":
+            mb = self.lower_midpoint( b, positions )
+            ma = self.upper_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.primary_scale + \
+                overlap * self.secondary_scale
+        elif r == "disjoint":
+            return overlap * self.primary_scale
+        elif r == "place-left":
+            mb = self.left_midpoint( b, positions )
+            ma = self.right_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.secondary_scale + \
+                overlap * self.primary_scale
+        elif r == "place-right":
+            mb = self.right_midpoint( b, positions )
+            ma = self.left_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.secondary_scale + \
+                overlap * self.primary_scale
+        elif r == "place-above":
+            mb = self.upper_midpoint( b, positions )
+            ma = self.lower_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.secondary_scale + \
+                overlap * self.primary_scale
+        elif r == "place-below":
+            mb = self.lower_midpoint( b, positions )
+            ma = self.upper_midpoint( a, positions )
+            return distance_sq( ma, mb ) * self.secondary_scale + \
+                overlap * self.primary_scale
+        else:
+            logger.warning( "unhandled relation %s", r )
+            return 0.0
+
+    def penalty_terms( self, positions ):
+        return [ self.relation_penalty( rel, positions )
+                 for rel in self.relations ]
+    
+    def build_grid( self, positions ):
+        boxes = [ self.boundary_in( n, positions ) for n in self.members ]
+        grid = UniformGrid( cell_size_for( boxes ) )
+        for i, box in enumerate( boxes ):
+            grid.insert( i, box )
+        return grid
+
+    def pair_term( self, pairs, i, j, members, positions ):
+        if i > j:
+            i, j = j, i
+        overlap = self.overlap_in( members[i], members[j], positions )
+        if overlap > 0.0:
+            pairs[(i, j)] = overlap * self.primary_scale
+        
+    def pair_terms( self, positions, grid = None ):
+        """With all_disjoint, return the overlap penalty of every pair of
+        overlapping members, keyed by their indices in self.members;
+        otherwise None."""
+        if not self.all_disjoint:
+            return None
+        if grid is None:
+            grid = self.build_grid( positions )
+        members = list( self.members )
+        pairs = {}
+        for i, j in grid.candidate_pairs():
+            self.pair_term( pairs, i, j, members, positions )
+        return pairs
+
+    def set_terms( self, terms ):
+        """Make 'terms' the current relation terms, keeping their exact
+        total as an integer."""
+        self.current_terms = terms
+        self.term_units = sum( exact_units( t ) for t in terms )
+
+    def set_pairs( self, pairs ):
+        """Make 'pairs' the current overlapping pairs, indexing them by
+        member, and keeping their exact total as an integer."""
+        self.current_pairs = pairs
+        self.pair_index = {}
+        for k in pairs:
+            self.pair_index.setdefault( k[0], set() ).add( k )
+            self.pair_index.setdefault( k[1], set() ).add( k )
+        self.pair_units = sum( exact_units( t ) for t in pairs.values() )
+
+    def incremental_pairs( self, positions, moved ):
+        """Find the change in the overlapping pairs when the elements in
+        'moved' move, using the grid index to find their new neighbours.
+        Returns the pairs removed, the pairs added, and the new exact
+        total."""
+        if self.grid is None:
+            self.grid = self.build_grid( self.current )
+        ids = [ self.member_id[n] for n in moved ]
+        removed = set()
+        for i in ids:
+            removed.update( self.pair_index.get( i, () ) )
+        added = {}
+        for n, i in zip( moved, ids ):
+            for j in self.grid.query( self.boundary_in( n, positions ) ):
+                if j not in ids:
+                    self.pair_term( added, i, j, self.member_list, positions )
+        if len( ids ) == 2:
+            self.pair_term( added, ids[0], ids[1], self.member_list, positions )
+
+        units = self.pair_units
+        for k in removed:
+            units -= exact_units( self.current_pairs[k] )
+        for t in added.values():
+            units += exact_units( t )
+        return removed, added, units
+
+    def apply_pairs( self, delta ):
+        removed, added, units = delta
+        for k in removed:
+            del self.current_pairs[k]
+            self.pair_index[k[0]].discard( k )
+            self.pair_index[k[1]].discard( k )
+        for k, t in added.items():
+            self.current_pairs[k] = t
+            self.pair_index.setdefault( k[0], set() ).add( k )
+            self.pair_index.setdefault( k[1], set() ).add( k )
+        self.pair_units = units
+
+    def combine( self, terms, pairs ):
+        if pairs is not None:
+            return math.fsum( terms + list( pairs.values() ) )
+        return math.fsum( terms )
+        
     def penalty( self, positions ):
-        total = 0.0
+        # The terms are summed exactly, and correctly rounded, by fsum
+        # here and with integers in incremental_penalty(), so the two
+        # agree exactly.
+        return self.combine( self.penalty_terms( positions ),
+                             self.pair_terms( positions ) )
 
-        for a, r, b in self.relations:
-            overlap = self.overlap_in( a, b, positions )
-
-            # TODO: maybe midpoint distance is the wrong thing,
-            # we should weight gap between edges more heavily?
-            if r == "adjacent-left":
-                mb = self.left_midpoint( b, positions )
-                ma = self.right_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.primary_scale + \
-                    overlap * self.secondary_scale
-            elif r == "adjacent-right":
-                mb = self.right_midpoint( b, positions )
-                ma = self.left_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.primary_scale + \
-                    overlap * self.secondary_scale
-            elif r == "adjacent-above":
-                mb = self.upper_midpoint( b, positions )
-                ma = self.lower_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.primary_scale + \
-                    overlap * self.secondary_scale
-            elif r == "adjacent-below":
-                mb = self.lower_midpoint( b, positions )
-                ma = self.upper_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.primary_scale + \
-                    overlap * self.secondary_scale
-            elif r == "disjoint":
-                total += overlap * self.primary_scale
-            elif r == "place-left":
-                mb = self.left_midpoint( b, positions )
-                ma = self.right_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.secondary_scale + \
-                    overlap * self.primary_scale
-            elif r == "place-right":
-                mb = self.right_midpoint( b, positions )
-                ma = self.left_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.secondary_scale + \
-                    overlap * self.primary_scale
-            elif r == "place-above":
-                mb = self.upper_midpoint( b, positions )
-                ma = self.lower_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.secondary_scale + \
-                    overlap * self.primary_scale
-            elif r == "place-below":
-                mb = self.lower_midpoint( b, positions )
-                ma = self.upper_midpoint( a, positions )
-                total += distance_sq( ma, mb ) * self.secondary_scale + \
-                    overlap * self.primary_scale
-            else:
-                print( "Unhandled relation", r )
-                
-        return total
+    def incremental_penalty( self, positions, moved ):
+        """Re-score only the relations (and, with all_disjoint, the
+        overlapping pairs) that touch a node in 'moved', and update the
+        exact total of the current state by the difference, so the cost
+        does not depend on the number of relations.  Returns the new
+        total, the changed terms with their new exact total, and the
+        change in the pairs."""
+        affected = set()
+        for n in moved:
+            affected.update( self.index.get( n, [] ) )
+
+        terms = {}
+        units = self.term_units
+        for i in affected:
+            t = self.relation_penalty( self.relations[i], positions )
+            units += exact_units( t ) - exact_units( self.current_terms[i] )
+            terms[i] = t
+        pairs = None
+        total_units = units
+        if self.all_disjoint:
+            pairs = self.incremental_pairs( positions, moved )
+            total_units += pairs[2]
+        # Correctly rounded, just like fsum
+        total = total_units / exact_scale
 
-    def random_change( self, positions ):
+        if self.check_incremental:
+            full = self.penalty( positions )
+            if full != total:
+                raise Exception( "Incremental penalty {} does not match full penalty {}".format( total, full ) )
+        return total, (terms, units), pairs
+
+    def random_move( self, positions ):
         # We want moves that produce somewhat similar penalties, rather
         # than big jumps.  But moving just one bounding box at a time
         # may easily get stuck in local minima.  So we'll move 1, 2 or 3
@@ -176,13 +667,16 @@ class Solver(object):
 
         # The size of the move should probably decrease with temperature.
 
-        if len( self.movable ) > 1:
-            a,b = random.sample( self.movable, 2 )
+        # Only the new positions of the moved elements are returned, so
+        # that a move does not copy every position.
+        if len( self.movable_list ) > 1:
+            a,b = self.rng.sample( self.movable_list, 2 )
         else:
-            a = random.sample( self.movable, 1 )[0]
+            a = self.movable_list[0]
             b = None
+        moved = [a]
             
-        np = positions.copy()
+        np = {}
 
         scale = 1.0
         if self.temperature < 200:
@@ -196,50 +690,56 @@ class Solver(object):
         a_height = bb_a.y2 - bb_a.y1
         #print( "Range: ", a_width *scale, a_height *scale )
         
-        np[a] = ( np[a][0] + random.uniform( -a_width * scale,
-                                             a_width * scale ),
-                  np[a][1] + random.uniform( -a_height * scale,
-                                             a_height * scale ) )
+        np[a] = ( positions[a][0] + self.rng.uniform( -a_width * scale,
+                                                    a_width * scale ),
+                  positions[a][1] + self.rng.uniform( -a_height * scale,
+                                                    a_height * scale ) )
         
-        if b is not None and random.random() < 0.3:
+        if b is not None and self.rng.random() < 0.3:
             bb_b = self.bounding_box( b )
             b_width = bb_b.x2 - bb_b.x1
             b_height = bb_b.y2 - bb_b.y1
-            np[b] = ( np[b][0] + random.uniform( -b_width * scale,
-                                                 b_width * scale ),
-                      np[b][1] + random.uniform( -b_height * scale,
-                                                 b_height * scale ) )
+            np[b] = ( positions[b][0] + self.rng.uniform( -b_width * scale,
+                                                        b_width * scale ),
+                      positions[b][1] + self.rng.uniform( -b_height * scale,
+                                                        b_height * scale ) )
+            moved.append( b )
         
-        return np
+        return np, moved
         
     def initial_temperature( self ):
+        """Estimate a temperature at which most uphill moves from the
+        starting state are accepted, scoring the sampled moves
+        incrementally where the solver can."""
         num_samples = 100
         prob_accept = 0.8
-        current = dict( self.current )
-        val = self.penalty( current )
+        val = self.current_penalty
         total_increases = 0.0
         num_increases = 0
         
         for i in range( num_samples ):
-            np = self.random_change( current )
-            nv = self.penalty( np )
+            changes, moved = self.random_move( self.current )
+            if self.incremental:
+                nv = self.incremental_penalty(
+                    ChainMap( changes, self.current ), moved )[0]
+            else:
+                np = dict( self.current )
+                np.update( changes )
+                nv = self.penalty( np )
             if nv > val:
                 total_increases += ( nv - val )
                 num_increases += 1
-            # Accept always
-            current = np
-            val = nv
 
         if self.verbose:
-            print( "Num increases:", num_increases )
-            print( "Total increases:", total_increases )
+            logger.debug( "num increases: %s, total increases: %s",
+                          num_increases, total_increases )
         if num_increases == 0:
             return 1000.0
         else:
             return - (total_increases / num_increases) / math.log( prob_accept )
         
-    def decrease_temperature( self, temp ):
-        return temp * 0.95
+    def decrease_temperature( self, temp, acceptance = 1.0 ):
+        return self.schedule.next_temperature( temp, acceptance )
 
     def probability_accept( self, e1, e2, temp ):
         if e2 < e1:
@@ -247,59 +747,230 @@ class Solver(object):
         else:
             return math.exp( (e1 - e2) / temp )
         
+    def accept( self, changes, penalty ):
+        """Move to a new current state, where the elements in 'changes'
+        have new positions.  The positions are changed in place; the best
+        state is kept as the positions that the elements moved since had
+        then, in best_undo, so that only moved elements are copied."""
+        undo = self.best_undo
+        current = self.current
+        for n, p in changes.items():
+            if n not in undo:
+                undo[n] = current[n]
+            current[n] = p
+        self.current_penalty = penalty
+        if penalty < self.best_penalty:
+            self.best_undo = {}
+            self.best_penalty = penalty
+            self.best_temperature = self.temperature
+
+    def best_positions( self ):
+        """The best state found so far, as a new dict of positions."""
+        best = dict( self.current )
+        best.update( self.best_undo )
+        return best
+
     def annealing_iter( self ):
-        step = self.random_change( self.current )
-        penalty = self.penalty( step )
+        changes, moved = self.random_move( self.current )
+        if self.incremental:
+            penalty, terms, pairs = self.incremental_penalty(
+                ChainMap( changes, self.current ), moved )
+        else:
+            step = dict( self.current )
+            step.update( changes )
+            terms = self.penalty_terms( step )
+            pairs = self.pair_terms( step )
+            penalty = self.combine( terms, pairs )
         p = self.probability_accept( self.current_penalty, penalty, self.temperature )
         if self.verbose:
-            print( "delta", self.current_penalty - penalty, "prob", p )
-        if random.random() <= p:
-            self.current = step
-            self.current_penalty = penalty
-            if self.current_penalty < self.best_penalty:
-                self.best = self.current
-                self.best_penalty = self.current_penalty
-                self.best_temperature = self.temperature
+            logger.debug( "delta %s prob %s", self.current_penalty - penalty, p )
+        if self.rng.random() <= p:
+            self.accept( changes, penalty )
+            if self.incremental:
+                terms, self.term_units = terms
+                for i, t in terms.items():
+                    self.current_terms[i] = t
+                if pairs is not None:
+                    self.apply_pairs( pairs )
+                    for n in moved:
+                        self.grid.move( self.member_id[n],
+                                        self.boundary_in( n, self.current ) )
+            else:
+                self.set_terms( terms )
+                if pairs is not None:
+                    self.set_pairs( pairs )
+                    self.grid = None
             return True
         
         return False
 
+    def annealing_step( self, num_iterations, max_accepts = None ):
+        """Run up to num_iterations iterations at the current temperature,
+        stopping early after max_accepts accepted moves, then lower the
+        temperature according to the schedule."""
+        if max_accepts is None:
+            max_accepts = self.max_accepts
+        prev_best = self.best_penalty
+        num_accepts = 0
+        num_tries = 0
+        for i in range( num_iterations ):
+            self.accept_denom += 1
+            num_tries += 1
+            if self.annealing_iter():
+                #print( "Accept", self.current )
+                self.record()
+                num_accepts += 1
+                self.accept_num += 1
+                if num_accepts >= max_accepts:
+                    break
+                if self.stop_at_zero and self.best_penalty == 0.0:
+                    break
+        if self.best_penalty >= prev_best * ( 1.0 - self.stagnation_tolerance ):
+            self.stale_steps += 1
+        else:
+            self.stale_steps = 0
+        if self.best_penalty == prev_best:
+            if self.verbose:
+                logger.debug( "no improvement at temperature %s, "
+                              "acceptance ratio: %s", self.temperature,
+                              self.accept_num / self.accept_denom )
+                
+        self.temperature = self.decrease_temperature(
+            self.temperature, num_accepts / num_tries if num_tries else 0.0 )
+        if self.verbose:
+            logger.debug( "lowered temperature to %s", self.temperature )
+        return num_accepts
+
+    def finished( self ):
+        """Check the early-termination criteria."""
+        if self.stop_at_zero and self.best_penalty == 0.0:
+            return True
+        if self.stagnation_steps is not None and \
+           self.stale_steps >= self.stagnation_steps:
+            return True
+        return self.temperature <= self.min_temperature
+
+    def default_iterations( self ):
+        # Members of an all_disjoint group may have no relations
+        return max( len( self.relations ), len( self.movable ) ) * 20
+
     def annealing( self, num_iterations = None ):
-        min_temperature = 0.1
         if num_iterations is None:
-            num_iterations = len( self.relations ) * 20
-        max_accepts = 100
-        accept_num = 0.0
-        accept_denom = 0.0
+            num_iterations = self.default_iterations()
+        self.accept_num = 0.0
+        self.accept_denom = 0.0
+        self.stale_steps = 0
         
-        while self.temperature > min_temperature:
-            prev_best = self.best_penalty
-            num_accepts = 0
-            for i in range( num_iterations ):
-                accept_denom += 1
-                if self.annealing_iter():
-                    #print( "Accept", self.current )
-                    for m in self.movable:
-                        self.paths[m].append( self.current[m] )
-                    self.penalties.append( self.current_penalty )
-                    self.temps.append( self.temperature )
-                    num_accepts += 1
-                    accept_num += 1
-                    if num_accepts >= max_accepts:
-                        break
-            if self.best_penalty == prev_best:
-                if self.verbose:
-                    print( "No improvement at temperature", self.temperature )
-                    ratio = accept_num / accept_denom
-                    print( "Acceptance ratio:", ratio )
-                
-            self.temperature = self.decrease_temperature( self.temperature )
-            if self.verbose:
-                print( "*** Lowered temperature to", self.temperature )
+        while not self.finished():
+            self.annealing_step( num_iterations )
+        self.best = self.best_positions()
+
+        logger.debug( "final penalty: %s", self.current_penalty )
+        logger.debug( "best penalty: %s at temperature %s",
+                      self.best_penalty, self.best_temperature )
+
+    def copy_relations( self ):
+        """Return a solver with the same settings and relations, that has
+        not been started."""
+        s = self.empty_copy()
+        if self.all_disjoint:
+            for e in self.members:
+                if self.bounding_box( e ).x1 is not None:
+                    s.add_element( e )
+        for a, r, b in self.relations:
+            s.add_edge( a, r, b )
+        return s
 
-        print( "Final penalty:", self.current_penalty )
-        print( "Best penalty:", self.best_penalty, "at temperature", self.best_temperature )
+    def tempering( self, chains = 4, ratio = 2.0, num_iterations = None,
+                   seed = None ):
+        """Multi-start parallel tempering.
+
+        Run 'chains' annealing chains, each from a different random
+        starting point (the first from initial_positions()), at temperatures
+        spaced by 'ratio'.  After every temperature step, neighbouring
+        chains swap temperatures with the usual Metropolis probability,
+        so a good configuration found by a hot chain can be refined by a
+        cold one.  Each chain lowers its temperature by the schedule,
+        and the search stops when the coldest chain meets the termination
+        criteria, or any chain reaches zero penalty.  The chains run
+        in-process, one temperature step each in turn, as they exchange
+        temperatures after every step; placement problems are spread
+        across processes whole, see render.place_layout().  Sets and
+        returns the best positions found by any chain."""
+        if num_iterations is None:
+            num_iterations = self.default_iterations()
+        rng = random.Random( seed ) if seed is not None else \
+            ( self.rng or random )
+
+        solvers = []
+        for i in range( chains ):
+            c = self.copy_relations()
+            c.rng = random.Random( rng.getrandbits( 64 ) )
+            c.start( scatter = ( i > 0 ) )
+            c.accept_num = 0.0
+            c.accept_denom = 0.0
+            c.stale_steps = 0
+            solvers.append( c )
+
+        t0 = solvers[0].temperature
+        for i, c in enumerate( solvers ):
+            c.temperature = t0 * ratio ** i
+            c.best_temperature = c.temperature
+
+        # Stop when the coldest chain is done, or any chain reaches zero.
+        # A hot chain going stale or reaching its minimum temperature
+        # does not end the search.
+        while not ( min( solvers, key = lambda c: c.temperature ).finished() or
+                    ( self.stop_at_zero and
+                      any( c.best_penalty == 0.0 for c in solvers ) ) ):
+            for c in solvers:
+                c.annealing_step( num_iterations )
+
+            ladder = sorted( solvers, key = lambda c: c.temperature )
+            for cold, hot in zip( ladder, ladder[1:] ):
+                delta = ( cold.current_penalty - hot.current_penalty ) * \
+                    ( 1.0 / cold.temperature - 1.0 / hot.temperature )
+                if delta >= 0 or rng.random() < math.exp( delta ):
+                    cold.temperature, hot.temperature = \
+                        hot.temperature, cold.temperature
+
+        winner = min( solvers, key = lambda c: c.best_penalty )
+        self.current = winner.current
+        self.current_penalty = winner.current_penalty
+        self.best = winner.best_positions()
+        self.best_penalty = winner.best_penalty
+        self.best_temperature = winner.best_temperature
+        logger.debug( "best penalty: %s at temperature %s",
+                      self.best_penalty, self.best_temperature )
+        return self.best
     
+# Floats are integer multiples of 2**-1074, so sums of them can be kept
+# exactly as integers in those units.
+exact_scale = 1 << 1074
+
+def exact_units( x ):
+    n, d = x.as_integer_ratio()
+    return n * ( exact_scale // d )
+
+def solve_detached( solver, seed, chains = 1 ):
+    """Solve a detached solver with its own random number generator,
+    using parallel tempering if chains is more than one.  This is the
+    unit of work sent to worker processes; it returns the best positions
+    and penalty found."""
+    solver.rng = random.Random( seed )
+    solver.solve_component( chains )
+    return solver.best, solver.best_penalty
+
+def solver_class( backend ):
+    """Look up a placement solver by name: "python" for Solver, or
+    "numpy" for the array-backed ArraySolver."""
+    if backend == "python":
+        return Solver
+    elif backend == "numpy":
+        from .arraysolver import ArraySolver
+        return ArraySolver
+    else:
+        raise Exception( "Unknown solver backend '{}'".format( backend ) )
 
 def distance( a, b ):
     x1,y1 = a
@@ -320,6 +991,11 @@ class FakeElement(object):
         self.y2 = y2
         
 if __name__ == "__main__":
+    # Only the demo needs these; importing matplotlib is slow.
+    import networkx as nx
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+
     g = nx.DiGraph()
     a = FakeElement( 10, 10, 20, 20 )
     b = FakeElement( 10, 10, 20, 20 )
@@ -329,8 +1005,11 @@ if __name__ == "__main__":
     g.add_node( "b", drawn=b ) 
     g.add_node( "c", drawn=c ) 
     g.add_node( "d", drawn=d ) 
+    logging.basicConfig()
+    logger.setLevel( logging.DEBUG )
     s = Solver( g )
     s.verbose = True
+    s.trace = "full"
     s.add_edge( "a", "place-left", "b" )
     s.add_edge( "c", "place-left", "b" )
     s.add_edge( "a", "disjoint", "c" )
@@ -0,0 +1,85 @@
+"""Render plans: everything rendering needs from an expanded graph,
+resolved once.
+
+A plan holds the elements to draw, with their attributes already
+evaluated and validated, the tree of groups, the z-order and the
+placement relations.  It is built from plain tuples, strings and
+numbers, so it is immutable, cheap to pickle to a worker process, and
+can be saved to disk as JSON and rendered again later.  See
+render.compile_plan() and render.render_plan()."""
+import json
+from collections import namedtuple
+
+# One element to draw.  'tag' is "rect", "circle", "path" or "g", and
+# 'geometry' holds the attributes it is drawn from:
+#   rect    (x, y, width, height)
+#   circle  (cx, cy, r)
+#   path    (d,)
+#   g       ()
+# 'attributes' are the remaining SVG attributes as (name, value) pairs,
+# and 'group' is the PlanGroup of a "g" element, None otherwise.
+PlanElement = namedtuple( "PlanElement",
+                          [ "node", "tag", "geometry", "attributes", "group" ] )
+
+# The contents of a group.  'elements' are drawn in order, which is also
+# the z-order.  'members' are (node, relations) pairs for the elements
+# that are placed and added to the group, where relations are
+# (relation, node) pairs.  'disjoint' is true if no two members may
+# overlap.
+PlanGroup = namedtuple( "PlanGroup",
+                        [ "node", "elements", "members", "disjoint" ] )
+
+# A whole drawing: the viewbox (x, y, width, height) and the top-level
+# group.
+RenderPlan = namedtuple( "RenderPlan", [ "viewbox", "root" ] )
+
+# Increase when the plan format changes, so old saved plans are rejected
+plan_version = 2
+
+def group_to_json( group ):
+    return { "node" : group.node,
+             "elements" : [ element_to_json( e ) for e in group.elements ],
+             "members" : group.members,
+             "disjoint" : group.disjoint }
+
+def element_to_json( element ):
+    return { "node" : element.node,
+             "tag" : element.tag,
+             "geometry" : element.geometry,
+             "attributes" : element.attributes,
+             "group" : group_to_json( element.group )
+             if element.group is not None else None }
+
+def group_from_json( data ):
+    return PlanGroup( data["node"],
+                      tuple( element_from_json( e ) for e in data["elements"] ),
+                      tuple( ( e, tuple( tuple( r ) for r in relations ) )
+                             for e, relations in data["members"] ),
+                      data["disjoint"] )
+
+def element_from_json( data ):
+    return PlanElement( data["node"], data["tag"], tuple( data["geometry"] ),
+                        tuple( tuple( a ) for a in data["attributes"] ),
+                        group_from_json( data["group"] )
+                        if data["group"] is not None else None )
+
+def save_plan( plan, path ):
+    """Save a plan as JSON.  Unlike a pickle, loading it can't run any
+    code, so plan files can be shared."""
+    with open( path, "w" ) as f:
+        json.dump( { "version" : plan_version,
+                     "viewbox" : plan.viewbox,
+                     "root" : group_to_json( plan.root ) },
+                   f, separators = (",", ":") )
+
+def load_plan( path ):
+    try:
+        with open( path ) as f:
+            data = json.load( f )
+    except ValueError:
+        raise Exception( "{} is not a saved render plan".format( path ) )
+    version = data.get( "version" ) if isinstance( data, dict ) else None
+    if version != plan_version:
+        raise Exception( "Render plan {} has version {}, expected {}".format(
+            path, version, plan_version ) )
+    return RenderPlan( tuple( data["viewbox"] ), group_from_json( data["root"] ) )
@@ -1,8 +1,17 @@
+import concurrent.futures
+import functools
+import logging
+import random
+from collections import deque
 import networkx as nx
 import svgwrite
-from .evaluate import extract_all_attributes
-import svgrammar.bounding as bounding
-from .placement import Solver
+from .elements import ElementTable
+from .evaluate import EdgeIndex, EvaluationContext
+from .placement import Solver, solve_detached
+from .plan import PlanElement, PlanGroup, RenderPlan
+from .writer import write_svg
+
+logger = logging.getLogger( __name__ )
 
 def bang_reference( g, n, visited ):
     if n in visited:
@@ -17,29 +26,6 @@ def bang_reference( g, n, visited ):
         return n
 
     
-class Element(object):
-    def __init__( self, n, svg, bb ):
-        self.svg_element = svg
-        self.bounding_box = bb
-        self.node = n
-        
-    def addElement( self, other ):
-        self.bounding_box.addElement( other.bounding_box )
-        self.svg_element.add( other.svg_element )
-
-    def doTransform( self ):
-        if "transform" in self.svg_element.attribs:
-            self.bounding_box.applyTransform( self.svg_element.attribs["transform"] )
-
-    def translate( self, dx, dy ):
-        # We want this operation to be performed *last*, so it must
-        # appear *first* in the list.
-        tmp = " " + self.svg_element.attribs.get("transform", "") 
-        self.svg_element.attribs["transform"] = ""
-        self.svg_element.translate( dx, dy )
-        self.svg_element.attribs["transform"] += tmp
-        self.bounding_box.translate( dx, dy )
-        
 svgElements = [ 'g', 'svg', 'rect', 'circle', 'path' ]
 
 def consume_float( attr, key, default ):
@@ -63,46 +49,65 @@ placement_relations = set( ["adjacent-left", "adjacent-right",
                             "disjoint" ])
 expected_invalid = placement_relations.union( set( ["below"] ) )
 
+# Grammars repeat the same few attribute values, like fill="none", so
+# validation results are cached.  A bad value for a known attribute still
+# raises TypeError every time.
+@functools.lru_cache( maxsize = 4096, typed = True )
+def attribute_allowed( elementname, attributename, value ):
+    try:
+        validator.check_svg_attribute_value( elementname, attributename, value )
+        return True
+    except ValueError:
+        return False
+
+# Valid attribute names by element, filled in by precompile_attribute_table()
+allowed_attributes = {}
+
+def precompile_attribute_table( elements = svgElements ):
+    """Look up the valid attribute names of each element in advance, so
+    that rejecting an unknown attribute is a set lookup."""
+    for e in elements:
+        allowed_attributes[e] = validator.elements[e].valid_attributes
+
 def strip_invalid_attributes( elementname, attr ):
+    names = allowed_attributes.get( elementname )
     for k in list( attr.keys() ):
-        try:
-            validator.check_svg_attribute_value( elementname, k, attr[k] )
-        except ValueError:
+        if names is not None and k not in names:
+            allowed = False
+        else:
+            allowed = attribute_allowed( elementname, k, attr[k] )
+        if not allowed:
             if k not in expected_invalid:
-                print( 'Removed attribute {}="{}"'.format( k, attr[k] ) )
+                logger.info( 'removed attribute %s="%s"', k, attr[k] )
             del attr[k]
             
     return attr
     
-def draw_circle( drawing, g, n ):
-    attr = extract_all_attributes( g, n )
+def plan_circle( context, n ):
+    attr = context.attributes( n )
     x = consume_float( attr, "cx", 0 )
     y = consume_float( attr, "cy", 0 )
     radius = consume_float( attr, "r", 0 )
     strip_invalid_attributes( "circle", attr )
+    return PlanElement( n, "circle", (x, y, radius), tuple( attr.items() ),
+                        None )
 
-    return Element( n,
-                    drawing.circle( (x, y), radius, **attr),
-                    bounding.CircleBoundingBox( x, y, radius ) )
-        
-def draw_rect( drawing, g, n ):
-    attr = extract_all_attributes( g, n )
+def plan_rect( context, n ):
+    attr = context.attributes( n )
     x = consume_float( attr, "x", 0 )
     y = consume_float( attr, "y", 0 )
     width = consume_float( attr, "width", 0 )
     height = consume_float( attr, "height", 0 )
     strip_invalid_attributes( "rect", attr )
+    return PlanElement( n, "rect", (x, y, width, height),
+                        tuple( attr.items() ), None )
 
-    return Element( n,
-                    drawing.rect( (x, y), (width, height), **attr ),
-                    bounding.RectangleBoundingBox( x, y, width, height ) )
-
-def draw_path( drawing, g, n ):
-    attr = extract_all_attributes( g, n, ["d_list"] )
+def plan_path( context, n ):
+    attr = context.attributes( n, ["d_list"] )
     if "d_list" in attr:
         d = " ".join( attr.pop( "d_list" ) )
         if "d" in attr:
-            print( "Both d_list and d found at node {}", n )
+            logger.warning( "both d_list and d found at node %s", n )
             del attr["d"]
     elif "d" in attr:
         d = attr.pop( "d" )
@@ -110,117 +115,303 @@ def draw_path( drawing, g, n ):
         d = ""
         
     strip_invalid_attributes( "path", attr )
-    return Element( n,
-                    drawing.path( d, **attr ),
-                    bounding.PathBoundingBox( d ) )
-
-def create_group( drawing, g, n ):
-    attr = extract_all_attributes( g, n )
-    children = []
-    for i, j, t in g.out_edges( n, data="tag" ):
-        if t is None:
-            children.append( j )
-            
+    return PlanElement( n, "path", (d,), tuple( attr.items() ), None )
+
+def plan_group( context, n, parents ):
+    attr = context.attributes( n )
+    children = find_order( context.index,
+                           context.index.untagged.get( n, [] ) )
+    placement = attr.pop( "placement", None )
     strip_invalid_attributes( "g", attr )
-    element = Element( n,
-                       drawing.g( **attr ),
-                       bounding.GroupBoundingBox() )
-    return element, find_order( g, children )
+    group = compile_group( context, n, children, parents,
+                           placement == "disjoint" )
+    return PlanElement( n, "g", (), tuple( attr.items() ), group )
 
-    
-def render_to_drawing( drawing, in_group, g, elems, parents = [] ):
+def compile_group( context, node, elems, parents = [], disjoint = False ):
+    """Evaluate the elements of a group and, recursively, all its
+    subgroups, and collect their placement relations into a PlanGroup."""
+    g = context.graph
     elems = list( elems )
-    
-    # Assemble drawing first
+    elements = []
+    drawn = set()
     for e in elems:
         if e in parents:
             raise Exception( "Circular rendering at node '" + str( e ) + "'" )
 
-
         e = bang_reference( g, e, parents )
         
         tag = g.nodes[e]["tag"]
-        drawn = None
-        print( "Rendering", e, "tag", tag )
+        logger.debug( "rendering %s tag %s", e, tag )
         
         if tag == "rect":
-            drawn = draw_rect( drawing, g, e )
+            elements.append( plan_rect( context, e ) )
         elif tag == "circle":
-            drawn = draw_circle( drawing, g, e )
+            elements.append( plan_circle( context, e ) )
         elif tag == "path":
-            drawn = draw_path( drawing, g, e )
+            elements.append( plan_path( context, e ) )
         elif tag == "g":
-            drawn, children = create_group( drawing, g, e )
-            render_to_drawing( drawing, drawn, g, children, parents + [e] )
-
-        if drawn is not None:
-            g.nodes[e]["drawn"] = drawn
-            drawn.doTransform()
-            print( "element", tag, e, "bounding box:", drawn.bounding_box )
+            elements.append( plan_group( context, e, parents + [e] ) )
+        else:
+            continue
+        drawn.add( e )
 
-    # Look for any placement attributes
-    s = Solver( g )
+    # Look for any placement attributes.  Elements reached through a '!'
+    # reference are drawn, but not members of the group.
+    members = []
     for e in elems:
-        if "drawn" in g.nodes[e]:
-            for i,j,t in g.out_edges( e, data="tag" ):
-                if t in placement_relations:
-                    j = bang_reference( g, j,  [] )
-                    if j not in elems:
-                        
-                        print( "WARNING: ignoring cross-group placement {} -> {}".format( i, j ) )
-                        continue
-                    s.add_edge( i, t, j )
+        if e in drawn:
+            relations = []
+            for t, j in context.index.placement.get( e, [] ):
+                j = bang_reference( g, j,  [] )
+                if j not in elems:
+                    logger.warning( "ignoring cross-group placement %s -> %s", e, j )
+                    continue
+                relations.append( (t, j) )
+            members.append( (e, tuple( relations )) )
 
-    
-    if len( s.relations ) != 0:
-        s.start()
-        s.annealing()
-        print( "Placements:", s.best )
-        for n, (x,y) in s.best.items():
-            (x,y) = round_translation(x,y)
-            g.nodes[n]["drawn"].translate( x, y )
-            
-    # Add final locations to element
-    for e in elems:
-        if "drawn" in g.nodes[e]:
-            in_group.addElement( g.nodes[e]["drawn"] )
+    return PlanGroup( node, tuple( elements ), tuple( members ), disjoint )
 
-def round_translation(x,y):
-    # FIXME: scale based on size of image?
-    return ( round( x, 6 ),
-             round( y, 6 ) )
-        
-def graph_to_svg( g ):
-    svg, elems = top_level_elements( g )
-    
-    d = svgwrite.Drawing( size=("8in","8in") )
+def compile_plan( g, context = None ):
+    """Resolve everything rendering needs from the graph into a
+    RenderPlan, which render_plan() can draw any number of times."""
+    if context is None:
+        context = EvaluationContext( g )
+    svg, elems = top_level_elements( g, context.index )
     if svg is not None:
-        attr = extract_all_attributes( g, svg )
+        attr = context.attributes( svg )
         width = consume_float( attr, "width", 200 )
         height = consume_float( attr, "height", 200 )
         x = consume_float( attr, "x", 0 )
         y = consume_float( attr, "y", 0 )
-        d.viewbox( x, y, width, height )
+        viewbox = (x, y, width, height)
         # TODO: remaining attributes?
     else:
-        d.viewbox( 0, 0, 200, 200 )
+        viewbox = (0, 0, 200, 200)
+    return RenderPlan( viewbox, compile_group( context, None, elems ) )
+
+def draw_element( drawing, table, i ):
+    """Create the svgwrite element for element i of an ElementTable, as
+    placed, with the members of a group added to it."""
+    element = table.elements[i]
+    attr = dict( element.attributes )
+    transform_attr = table.transform_attribute( i )
+    if transform_attr is not None:
+        attr["transform"] = transform_attr
+    if element.tag == "rect":
+        x, y, width, height = element.geometry
+        return drawing.rect( (x, y), (width, height), **attr )
+    elif element.tag == "circle":
+        x, y, radius = element.geometry
+        return drawing.circle( (x, y), radius, **attr )
+    elif element.tag == "path":
+        d, = element.geometry
+        return drawing.path( d, **attr )
+    else:
+        g = drawing.g( **attr )
+        draw_members( drawing, g, table, i )
+        return g
+
+def draw_members( drawing, container, table, group ):
+    """Add the members of a group, given by its id in the ElementTable or
+    None for the top level, to an svgwrite container, in order."""
+    for i in table.members[group]:
+        container.add( draw_element( drawing, table, i ) )
 
-    container = Element( svg, d, bounding.GroupBoundingBox() )
-    render_to_drawing( d, container, g, elems )
+class Layout(object):
+    """The elements of one group, drawn but not yet placed.  'group' is
+    the group's id in the ElementTable, or None for the top level."""
+    def __init__( self, group, solver ):
+        self.group = group
+        self.solver = solver
+        self.children = []
+
+def build_layout( table, in_group, group, solver_class = Solver,
+                  solver_options = {} ):
+    """Draw the elements of a PlanGroup and, recursively, all its
+    subgroups into an ElementTable, and set up their placement problems.
+    Returns a tree of Layouts.  solver_options are Solver settings such
+    as the cooling schedule.
+
+    An element shared by several groups is drawn once in each, and each
+    group places its own copy, so members and relations are looked up by
+    node among the elements drawn in this group, and the solver works on
+    their ids in the table."""
+    cls = solver_class
+    options = solver_options
+    if group.disjoint:
+        # Only for this group; its subgroups are placed as they ask
+        options = dict( solver_options, all_disjoint = True )
+        if not solver_class.supports_all_disjoint:
+            # Use the pure-Python solver, without the options only
+            # solver_class knows
+            cls = Solver
+            options = { k : v for k, v in options.items()
+                        if k in Solver.settings }
+    solver = cls( None ).configure( **options )
+    solver.boxes = table
+    layout = Layout( in_group, solver )
     
+    # Assemble drawing first
+    ids = {}
+    for element in group.elements:
+        i = table.add( element )
+        ids[element.node] = i
+        if element.tag == "g":
+            # A group's transform is applied once its contents are placed
+            layout.children.append(
+                build_layout( table, i, element.group,
+                              solver_class, solver_options ) )
+        else:
+            logger.debug( "element %s %s bounding box: %s",
+                          element.tag, element.node, table.box( i ) )
+
+    table.members[in_group] = [ ids[e] for e, relations in group.members ]
+    for e, relations in group.members:
+        if solver.all_disjoint:
+            solver.add_element( ids[e] )
+        for t, j in relations:
+            solver.add_edge( ids[e], t, ids[j] )
+
+    return layout
+
+def finish_layout( table, layout, placements ):
+    """Move the elements of a group to their solved positions, given by
+    id in the ElementTable, and update the group's bounding box."""
+    if len( placements ) != 0:
+        logger.debug( "placements: %s", placements )
+    for i, (x,y) in placements.items():
+        (x,y) = round_translation(x,y)
+        table.translate( i, x, y )
+
+    if layout.group is not None:
+        table.merge( layout.group, table.members[layout.group] )
+
+def place_layout( table, root, seed = None, executor = None, chains = 1 ):
+    """Solve the placement of every group in the tree under root.
+
+    A group's bounding box depends on how its members were placed, so
+    groups are solved innermost first: all the groups of the same height
+    in the tree are independent, and each of their constraint components
+    is solved as a separate detached problem.  These are run in-process
+    or, if a concurrent.futures executor is given, spread across its
+    workers.  Every problem gets its own random seed, drawn in a fixed
+    order from 'seed' (or the random module if None), so the result does
+    not depend on how many workers there are.  With chains > 1 each
+    problem is solved by parallel tempering."""
+    levels = {}
+    def visit( layout ):
+        height = 0
+        for c in layout.children:
+            height = max( height, visit( c ) + 1 )
+        levels.setdefault( height, [] ).append( layout )
+        return height
+    visit( root )
+
+    rng = random.Random( seed ) if seed is not None else random
+    for height in sorted( levels ):
+        problems = []
+        for layout in levels[height]:
+            for c in layout.solver.components():
+                problems.append( (layout, c.detach()) )
+                
+        seeds = [ rng.getrandbits( 64 ) for p in problems ]
+        solvers = [ c for layout, c in problems ]
+        num_chains = [ chains ] * len( problems )
+        if executor is None:
+            results = map( solve_detached, solvers, seeds, num_chains )
+        else:
+            results = executor.map( solve_detached, solvers, seeds,
+                                    num_chains )
+
+        placements = { id( layout ) : {} for layout in levels[height] }
+        for (layout, c), (best, best_penalty) in zip( problems, results ):
+            placements[id( layout )].update( best )
+            
+        for layout in levels[height]:
+            finish_layout( table, layout, placements[id( layout )] )
+
+def render_to_drawing( drawing, in_group, g, elems, parents = [],
+                       solver_class = Solver, solver_options = {},
+                       context = None ):
+    """Render elems of the graph, place them, and add them to in_group,
+    an svgwrite container of the drawing."""
+    if context is None:
+        context = EvaluationContext( g )
+    group = compile_group( context, None, elems, parents )
+    table = ElementTable()
+    layout = build_layout( table, None, group, solver_class, solver_options )
+    place_layout( table, layout )
+    draw_members( drawing, in_group, table, None )
+
+def round_translation(x,y):
+    # FIXME: scale based on size of image?
+    return ( round( x, 6 ),
+             round( y, 6 ) )
+
+# Width and height of the drawing
+drawing_size = ("8in", "8in")
+
+def place_plan( plan, solver_class = Solver, workers = None, seed = None,
+                chains = 1, solver_options = {} ):
+    """Draw a RenderPlan into an ElementTable and solve its placement.
+    The arguments are as for graph_to_svg()."""
+    table = ElementTable()
+    layout = build_layout( table, None, plan.root,
+                           solver_class = solver_class,
+                           solver_options = solver_options )
+    if workers:
+        with concurrent.futures.ProcessPoolExecutor( workers ) as executor:
+            place_layout( table, layout, seed, executor, chains )
+    else:
+        place_layout( table, layout, seed, chains = chains )
+    return table
+
+def render_plan( plan, solver_class = Solver, workers = None, seed = None,
+                 chains = 1, solver_options = {} ):
+    """Draw a RenderPlan and solve its placement, returning an svgwrite
+    Drawing.  The arguments are as for graph_to_svg()."""
+    d = svgwrite.Drawing( size=drawing_size )
+    d.viewbox( *plan.viewbox )
+    # Placement works on the compact table; the SVG elements are only
+    # created once everything is in place.
+    table = place_plan( plan, solver_class, workers, seed, chains,
+                        solver_options )
+    draw_members( d, d, table, None )
     return d
 
-def find_order( graph, nodes ):
+def write_plan( plan, out, pretty = False, solver_class = Solver,
+                workers = None, seed = None, chains = 1, solver_options = {} ):
+    """Draw a RenderPlan, solve its placement and stream it to out, a file
+    name or text file object, without building an svgwrite Drawing.  The
+    output is what render_plan()'s Drawing.write( out, pretty ) gives, for
+    less memory and time.  The other arguments are as for graph_to_svg()."""
+    table = place_plan( plan, solver_class, workers, seed, chains,
+                        solver_options )
+    write_svg( out, plan, table, drawing_size, pretty )
+
+def graph_to_svg( g, solver_class = Solver, workers = None, seed = None,
+                  chains = 1, solver_options = {} ):
+    """Render a graph to an svgwrite Drawing.  If workers is given,
+    placement problems are solved in a pool of that many processes;
+    chains > 1 solves each one by parallel tempering.  solver_options
+    are passed to Solver.configure().  The same as render_plan() on
+    compile_plan( g )."""
+    return render_plan( compile_plan( g ), solver_class, workers, seed,
+                        chains, solver_options )
+
+def find_order( index, nodes ):
+    """Sort nodes by their "below" edges, looked up in an EdgeIndex.  Ties
+    keep the order the nodes were given in, so the result does not
+    depend on hash order."""
     orderGraph = nx.DiGraph()
-    nodes = set( nodes )
+    nodes = dict.fromkeys( nodes )
     
     for n in nodes:
         orderGraph.add_node( n )
-        for i, j, t in graph.out_edges( n, data="tag" ):
-            if t == "below":
-                # FIXME: cross-level constraints?
-                if j in nodes:
-                    orderGraph.add_edge( i, j )
+        for j in index.below.get( n, [] ):
+            # FIXME: cross-level constraints?
+            if j in nodes:
+                orderGraph.add_edge( n, j )
 
     return nx.algorithms.dag.topological_sort( orderGraph )
     
@@ -234,46 +425,62 @@ def find_order( graph, nodes ):
 #
 # TODO: propogate order constraints from sub-elements up to the
 # top layer, somehow?
-def top_level_elements( g ):
+def top_level_elements( g, index = None ):
     """Find all recognized top-level tags within the graph, and sort them by
     z-order."""
-    untaggedEdges = [ (i,j) for i,j,t in g.edges( data="tag" ) if t is None ]
-    inclusionGraph = g.edge_subgraph( untaggedEdges ) 
+    if index is None:
+        index = EdgeIndex( g )
+    members = group_members( g, index )
     
     topTag = None
-    topLevel = set()
+    # Insertion-ordered, so that output does not depend on hash order
+    topLevel = {}
     
     for n, t in g.nodes( data="tag" ):
         if t == "svg":
             topTag = n
             # All the elements included are top-level by definition
             # though this is not required
-            if n in inclusionGraph.nodes:
-                for i, j in inclusionGraph.out_edges( n ):
-                    topLevel.add( j )
+            for j in index.untagged.get( n, [] ):
+                topLevel[j] = None
         elif t in svgElements:
             if n in topLevel:
                 continue
-            if not has_group_parent( inclusionGraph, n ):
-                topLevel.add( n )
+            if n not in members:
+                topLevel[n] = None
 
-    print( "Top level: ", topLevel )
+    logger.debug( "top level: %s", list( topLevel ) )
     
-    return topTag, find_order( g, topLevel )
+    return topTag, find_order( index, topLevel )
 
 
-def has_group_parent( g, n ):
-    if n not in g.nodes:
-        return False
-    
-    ancestors = nx.algorithms.traversal.depth_first_search.dfs_preorder_nodes( g.reverse(), n )
-    for a in ancestors:
-        if a == n:
-            continue
-        if g.nodes[a].get( 'tag', None ) == 'g':
-            # print( "Node", n, "has ancestor", a )
-            return True
-    return False
+def group_members( g, index ):
+    """Return the set of nodes reachable from a "g" node other than
+    themselves, by a path of untagged edges.  This is one breadth-first
+    search from all the groups at once.  Each node records up to two of
+    the groups that reach it, which is enough to tell whether one of
+    them is not the node itself."""
+    reached = {}
+    queue = deque()
+
+    def reach( n, group ):
+        groups = reached.setdefault( n, [] )
+        if len( groups ) < 2 and group not in groups:
+            groups.append( group )
+            queue.append( (n, group) )
+
+    for n, t in g.nodes( data="tag" ):
+        if t == "g":
+            for j in index.untagged.get( n, [] ):
+                reach( j, n )
+
+    while len( queue ) > 0:
+        n, group = queue.popleft()
+        for j in index.untagged.get( n, [] ):
+            reach( j, group )
+
+    return set( n for n, groups in reached.items()
+                if any( group != n for group in groups ) )
 
                     
                         
@@ -0,0 +1,67 @@
+"""Uniform grid spatial index over bounding boxes."""
+import math
+
+class UniformGrid(object):
+    """Buckets boxes, given as (x1, y1, x2, y2) tuples, by the square grid
+    cells they cover.  Two boxes can only overlap if they share a cell, so
+    a query only has to look at the boxes in the same cells.  Keys must
+    be orderable, so that each pair is reported once."""
+
+    def __init__( self, cell_size ):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = {}
+
+    def cell_range( self, box ):
+        x1, y1, x2, y2 = box
+        c = self.cell_size
+        return ( range( math.floor( x1 / c ), math.floor( x2 / c ) + 1 ),
+                 range( math.floor( y1 / c ), math.floor( y2 / c ) + 1 ) )
+
+    def insert( self, key, box ):
+        self.boxes[key] = box
+        xs, ys = self.cell_range( box )
+        for i in xs:
+            for j in ys:
+                self.cells.setdefault( (i, j), {} )[key] = None
+
+    def remove( self, key ):
+        xs, ys = self.cell_range( self.boxes.pop( key ) )
+        for i in xs:
+            for j in ys:
+                members = self.cells[(i, j)]
+                del members[key]
+                if len( members ) == 0:
+                    del self.cells[(i, j)]
+
+    def move( self, key, box ):
+        self.remove( key )
+        self.insert( key, box )
+
+    def query( self, box ):
+        """Return the keys of all boxes sharing a cell with 'box'."""
+        found = {}
+        xs, ys = self.cell_range( box )
+        for i in xs:
+            for j in ys:
+                found.update( self.cells.get( (i, j), {} ) )
+        return found.keys()
+
+    def candidate_pairs( self ):
+        """Return the set of (a, b) pairs, with a < b, that share a cell."""
+        pairs = set()
+        for members in self.cells.values():
+            keys = sorted( members )
+            for i, a in enumerate( keys ):
+                for b in keys[i+1:]:
+                    pairs.add( (a, b) )
+        return pairs
+
+def cell_size_for( boxes ):
+    """A cell size around the size of a typical box, so that most boxes
+    cover only a few cells."""
+    sizes = [ max( x2 - x1, y2 - y1 ) for x1, y1, x2, y2 in boxes ]
+    sizes = [ s for s in sizes if s > 0 ]
+    if len( sizes ) == 0:
+        return 1.0
+    return sum( sizes ) / len( sizes )
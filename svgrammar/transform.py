@@ -0,0 +1,162 @@
+"""Affine transforms, as used by the SVG transform attribute.
+
+A transform is the 3x3 matrix
+
+    [ a c e ]
+    [ b d f ]
+    [ 0 0 1 ]
+
+held as the tuple (a, b, c, d, e, f), in the same order as SVG's
+matrix(a,b,c,d,e,f).  It maps (x, y) to (a*x + c*y + e, b*x + d*y + f).
+"""
+import functools
+import logging
+import math
+import re
+
+logger = logging.getLogger( __name__ )
+
+identity = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+def multiply( m, n ):
+    """The transform that applies n, then m."""
+    a1, b1, c1, d1, e1, f1 = m
+    a2, b2, c2, d2, e2, f2 = n
+    return ( a1 * a2 + c1 * b2,
+             b1 * a2 + d1 * b2,
+             a1 * c2 + c1 * d2,
+             b1 * c2 + d1 * d2,
+             a1 * e2 + c1 * f2 + e1,
+             b1 * e2 + d1 * f2 + f1 )
+
+def translation( tx, ty = 0.0 ):
+    return (1.0, 0.0, 0.0, 1.0, tx, ty)
+
+def scaling( sx, sy = None ):
+    if sy is None:
+        sy = sx
+    return (sx, 0.0, 0.0, sy, 0.0, 0.0)
+
+def rotation( degrees, cx = 0.0, cy = 0.0 ):
+    """Rotation by an angle in degrees, clockwise in SVG's y-down
+    coordinates, about (cx, cy)."""
+    t = math.radians( degrees )
+    cos = math.cos( t )
+    sin = math.sin( t )
+    r = (cos, sin, -sin, cos, 0.0, 0.0)
+    if cx == 0.0 and cy == 0.0:
+        return r
+    return multiply( translation( cx, cy ),
+                     multiply( r, translation( -cx, -cy ) ) )
+
+def skew_x( degrees ):
+    return (1.0, 0.0, math.tan( math.radians( degrees ) ), 1.0, 0.0, 0.0)
+
+def skew_y( degrees ):
+    return (1.0, math.tan( math.radians( degrees ) ), 0.0, 1.0, 0.0, 0.0)
+
+def apply( m, x, y ):
+    a, b, c, d, e, f = m
+    return ( a * x + c * y + e, b * x + d * y + f )
+
+def is_translation( m ):
+    return m[0] == 1.0 and m[1] == 0.0 and m[2] == 0.0 and m[3] == 1.0
+
+def transform_box( m, x1, y1, x2, y2 ):
+    """The axis-aligned bounds of the box (x1,y1)--(x2,y2) after the
+    transform: exact for a rectangle, even if rotated or skewed."""
+    if is_translation( m ):
+        return ( x1 + m[4], y1 + m[5], x2 + m[4], y2 + m[5] )
+    xs = []
+    ys = []
+    for x, y in ( (x1, y1), (x2, y1), (x1, y2), (x2, y2) ):
+        tx, ty = apply( m, x, y )
+        xs.append( tx )
+        ys.append( ty )
+    return ( min( xs ), min( ys ), max( xs ), max( ys ) )
+
+def transform_ellipse( m, cx, cy, rx, ry ):
+    """The axis-aligned bounds of the axis-aligned ellipse with centre
+    (cx,cy) and radii rx, ry after the transform."""
+    a, b, c, d, e, f = m
+    x, y = apply( m, cx, cy )
+    hx = math.hypot( a * rx, c * ry )
+    hy = math.hypot( b * rx, d * ry )
+    return ( x - hx, y - hy, x + hx, y + hy )
+
+# One transform function and its argument list, followed by optional
+# whitespace and at most one comma.
+function_re = re.compile( r"\s*(matrix|translate|scale|rotate|skewX|skewY)\s*"
+                          r"\(([^)]*)\)\s*,?" )
+number_re = re.compile( r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?" )
+separator_re = re.compile( r"^[\s,]*$" )
+
+# Number of arguments each function accepts
+arities = {
+    "matrix" : (6,),
+    "translate" : (1, 2),
+    "scale" : (1, 2),
+    "rotate" : (1, 3),
+    "skewX" : (1,),
+    "skewY" : (1,),
+}
+
+def function_matrix( name, args ):
+    if name == "matrix":
+        return tuple( args )
+    elif name == "translate":
+        return translation( *args )
+    elif name == "scale":
+        return scaling( *args )
+    elif name == "rotate":
+        return rotation( *args )
+    elif name == "skewX":
+        return skew_x( *args )
+    else:
+        return skew_y( *args )
+
+@functools.lru_cache( maxsize = 1024 )
+def parse_transform( s ):
+    """Parse an SVG transform list into a single matrix.  Parsing stops,
+    with a warning, at anything that is not a valid transform function;
+    the functions before it still apply.  Results are cached, as the same
+    few strings come up again and again."""
+    m = identity
+    pos = 0
+    while pos < len( s ):
+        match = function_re.match( s, pos )
+        if match is None:
+            if s[pos:].strip() != "":
+                logger.warning( "unmatched transform '%s'", s[pos:] )
+            break
+
+        name, text = match.groups()
+        args = [ float( x ) for x in number_re.findall( text ) ]
+        if len( args ) not in arities[name] or \
+           not separator_re.match( number_re.sub( "", text ) ):
+            logger.warning( "invalid arguments in transform '%s'", match.group( 0 ).strip() )
+            break
+
+        m = multiply( m, function_matrix( name, args ) )
+        pos = match.end()
+    return m
+
+def number( v ):
+    # Rounded so that sums of translations don't print as 0.30000000000000004
+    return str( round( v, 6 ) + 0.0 )
+
+def coefficient( v, scale ):
+    # To significant digits, so that small scales keep their precision,
+    # with rounding errors like cos( 90 degrees ) next to 'scale' as zero
+    if abs( v ) <= scale * 1e-12:
+        return "0.0"
+    return str( float( "{:.12g}".format( v ) ) + 0.0 )
+
+def to_string( m ):
+    """The matrix as an SVG transform attribute."""
+    if is_translation( m ):
+        return "translate({},{})".format( number( m[4] ), number( m[5] ) )
+    scale = max( abs( v ) for v in m[:4] )
+    return "matrix({},{},{})".format(
+        ",".join( coefficient( v, scale ) for v in m[:4] ),
+        number( m[4] ), number( m[5] ) )
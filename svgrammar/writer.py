@@ -0,0 +1,141 @@
+"""Streaming SVG output.
+
+write_svg() writes a placed drawing, a RenderPlan and the ElementTable it
+was placed in, straight to a file one element at a time, without building
+an svgwrite tree first.  The output is the same as svgwrite's
+Drawing.write() for the same drawing: compact by default, or indented as
+svgwrite's pretty printer does."""
+import io
+
+header = '<?xml version="1.0" encoding="utf-8" ?>\n'
+
+# The attributes svgwrite.Drawing gives the svg element, less the size
+# and viewBox
+svg_attributes = {
+    "baseProfile" : "full",
+    "version" : "1.1",
+    "xmlns" : "http://www.w3.org/2000/svg",
+    "xmlns:ev" : "http://www.w3.org/2001/xml-events",
+    "xmlns:xlink" : "http://www.w3.org/1999/xlink",
+}
+
+def escape_attribute( text ):
+    """Escape an attribute value as xml.etree.ElementTree does."""
+    if "&" in text:
+        text = text.replace( "&", "&amp;" )
+    if "<" in text:
+        text = text.replace( "<", "&lt;" )
+    if ">" in text:
+        text = text.replace( ">", "&gt;" )
+    if "\"" in text:
+        text = text.replace( "\"", "&quot;" )
+    if "\r" in text:
+        text = text.replace( "\r", "&#13;" )
+    if "\n" in text:
+        text = text.replace( "\n", "&#10;" )
+    if "\t" in text:
+        text = text.replace( "\t", "&#09;" )
+    return text
+
+def escape_pretty_attribute( text ):
+    # As xml.dom.minidom does, which svgwrite pretty-prints with
+    return text.replace( "&", "&amp;" ).replace( "<", "&lt;" ). \
+        replace( "\"", "&quot;" ).replace( ">", "&gt;" )
+
+class SvgWriter(object):
+    """Writes SVG elements to a text file as they come.  Attributes are
+    written as svgwrite does: sorted by name, with "_" in names turned
+    into "-", and None or empty values left out."""
+    def __init__( self, out, pretty = False, indent = 2 ):
+        self.out = out
+        self.pretty = pretty
+        self.indent = " " * indent
+        self.depth = 0
+        self.escape = escape_pretty_attribute if pretty else escape_attribute
+
+    def start_tag( self, tag, attributes ):
+        attributes = { k.rstrip( "_" ).replace( "_", "-" ) : v
+                       for k, v in attributes.items() }
+        parts = [ "<", tag ]
+        names = sorted( attributes )
+        if self.pretty:
+            # minidom puts namespace declarations first
+            names.sort( key = lambda name: not name.startswith( "xmlns" ) )
+        for name in names:
+            value = attributes[name]
+            if value is None:
+                continue
+            value = str( value )
+            if value:
+                parts.append( ' {}="{}"'.format( name, self.escape( value ) ) )
+        if self.pretty:
+            parts.insert( 0, self.indent * self.depth )
+        return "".join( parts )
+
+    def empty( self, tag, attributes ):
+        """Write an element with no children."""
+        if self.pretty:
+            self.out.write( self.start_tag( tag, attributes ) + "/>\n" )
+        else:
+            self.out.write( self.start_tag( tag, attributes ) + " />" )
+
+    def open( self, tag, attributes ):
+        """Write the start tag of an element with children, which must be
+        followed by close()."""
+        self.out.write( self.start_tag( tag, attributes ) +
+                        ( ">\n" if self.pretty else ">" ) )
+        self.depth += 1
+
+    def close( self, tag ):
+        self.depth -= 1
+        if self.pretty:
+            self.out.write( "{}</{}>\n".format( self.indent * self.depth, tag ) )
+        else:
+            self.out.write( "</{}>".format( tag ) )
+
+def element_attributes( table, i ):
+    """The SVG tag and attributes of element i of an ElementTable, as
+    placed, the same as render.draw_element() gives it."""
+    element = table.elements[i]
+    attr = dict( element.attributes )
+    transform_attr = table.transform_attribute( i )
+    if transform_attr is not None:
+        attr["transform"] = transform_attr
+    if element.tag == "rect":
+        attr["x"], attr["y"], attr["width"], attr["height"] = element.geometry
+    elif element.tag == "circle":
+        attr["cx"], attr["cy"], attr["r"] = element.geometry
+    elif element.tag == "path":
+        attr["d"], = element.geometry
+    return element.tag, attr
+
+def write_members( writer, table, group ):
+    """Write the members of group, its id in the table or None for the
+    top level, in order."""
+    for i in table.members[group]:
+        tag, attr = element_attributes( table, i )
+        if tag == "g" and len( table.members[i] ) != 0:
+            writer.open( tag, attr )
+            write_members( writer, table, i )
+            writer.close( tag )
+        else:
+            writer.empty( tag, attr )
+
+def write_svg( out, plan, table, size, pretty = False, indent = 2 ):
+    """Write a drawing placed by render.place_plan() as an SVG document,
+    to out: a file name, or a text file object such as an open file or
+    socket.makefile( "w" ).  size is the (width, height) of the drawing."""
+    if not hasattr( out, "write" ):
+        with io.open( out, "w", encoding = "utf-8" ) as f:
+            write_svg( f, plan, table, size, pretty, indent )
+        return
+
+    out.write( header )
+    writer = SvgWriter( out, pretty, indent )
+    attr = dict( svg_attributes, width = size[0], height = size[1],
+                 viewBox = ",".join( str( v ) for v in plan.viewbox ) )
+    writer.open( "svg", attr )
+    # svgwrite always starts a drawing with its (empty) definitions
+    writer.empty( "defs", {} )
+    write_members( writer, table, None )
+    writer.close( "svg" )